@@ -2,13 +2,22 @@ import os
 import json
 import hmac
 import hashlib
-import requests
-import psycopg2
 from functools import wraps
 
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, jsonify, abort, Response
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+from db import db_cursor
+from dialog import Dialog, DIALOG_STEPS, save_turn, upsert_client
+from migrations import ensure_schema, init_schema, WHATSAPP_MIGRATIONS
+from dispatcher import create_pool
+from outbound import OutboundClient
+from dedup import Deduplicator
+from metrics import REGISTRY, timed
+from archive import MessageArchive
+from writer import BufferedWriter
+
 app = Flask(__name__)
 load_dotenv()
 
@@ -24,42 +33,80 @@ MANAGER_PHONE_NUMBER = os.environ.get("MANAGER_PHONE_NUMBER")
 if not all([APP_SECRET, PHONE_NUMBER_ID, ACCESS_TOKEN, DATABASE_URL, MANAGER_PHONE_NUMBER]):
     raise ValueError("One or more required environment variables are not set.")
 
-GRAPH_API_URL = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
+# GRAPH_API_BASE можно направить на локальную заглушку API (нагрузочные тесты)
+GRAPH_API_BASE = os.environ.get("GRAPH_API_BASE", "https://graph.facebook.com").rstrip("/")
+GRAPH_API_URL = f"{GRAPH_API_BASE}/v18.0/{PHONE_NUMBER_ID}/messages"
 
-# --- РАБОТА С БАЗОЙ ДАННЫХ ---
-def get_db_connection():
-    """Устанавливает соединение с базой данных."""
-    conn = psycopg2.connect(DATABASE_URL)
-    return conn
+# --- ИСХОДЯЩИЕ СООБЩЕНИЯ ---
+# Cloud API по умолчанию пропускает около 80 сообщений в секунду на номер.
+# GRAPH_GLOBAL_RATE — лимит на весь номер, он делится между воркерами gunicorn.
+OUTBOUND_PROCESSES = max(1, int(os.environ.get("WEB_CONCURRENCY", "2")))
+graph_outbound = OutboundClient(
+    "whatsapp",
+    global_rate=float(os.environ.get("GRAPH_GLOBAL_RATE", "80")) / OUTBOUND_PROCESSES,
+    per_key_rate=float(os.environ.get("GRAPH_RECIPIENT_RATE", "0")) or None,
+    workers=int(os.environ.get("OUTBOUND_WORKERS", "8")),
+)
+
+# --- ФОНОВАЯ ОБРАБОТКА ВЕБХУКОВ ---
+# INGEST_MODE=sync — обработка прямо в HTTP-запросе (как раньше);
+# INGEST_MODE=queue — вебхук только проверяет и ставит сообщение в очередь.
+INGEST_MODE = os.environ.get("INGEST_MODE", "sync")
+update_workers = create_pool(
+    "wa-updates",
+    workers=int(os.environ.get("INGEST_WORKERS", "4")),
+    queue_size=int(os.environ.get("INGEST_QUEUE_SIZE", "1000")),
+)
+
+# --- ОТСЕВ ПОВТОРНЫХ ДОСТАВОК ---
+# Meta повторяет вебхук, если не получила 200 вовремя; ключ — id сообщения (wamid).
+message_dedup = Deduplicator(
+    "whatsapp",
+    cache_size=int(os.environ.get("DEDUP_CACHE_SIZE", "50000")),
+    retention_hours=int(os.environ.get("DEDUP_RETENTION_HOURS", "48")),
+    cleanup_every=int(os.environ.get("DEDUP_CLEANUP_EVERY", "1000")),
+)
+
+# --- ГРУППОВАЯ ЗАПИСЬ СООБЩЕНИЙ ---
+# Те же MESSAGE_DURABILITY и пороги пачки, что у Telegram-бота (см. writer.py).
+message_writer = BufferedWriter(
+    "messages", ("client_id", "message_text", "sender_is_bot"),
+    durability=os.environ.get("MESSAGE_DURABILITY", "sync"),
+    max_rows=int(os.environ.get("MESSAGE_FLUSH_ROWS", "500")),
+    max_delay=float(os.environ.get("MESSAGE_FLUSH_MS", "20")) / 1000,
+)
+
+# --- СЕКЦИИ И АРХИВ СООБЩЕНИЙ ---
+# messages разбита на помесячные секции, старые месяцы уходят в ARCHIVE_DIR.
+message_archive = MessageArchive(
+    "messages",
+    directory=os.environ.get("ARCHIVE_DIR"),
+    hot_months=int(os.environ.get("MESSAGES_HOT_MONTHS", "6")),
+    interval=float(os.environ.get("ARCHIVE_INTERVAL", "3600")),
+)
+
+@app.before_request
+def start_background_jobs():
+    ensure_schema("whatsapp", WHATSAPP_MIGRATIONS)
+    message_archive.ensure_started()
+
+# --- МЕТРИКИ ---
+# /metrics отдает их в формате Prometheus; METRICS_TOKEN закрывает эндпоинт токеном.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+WEBHOOK_SECONDS = REGISTRY.histogram("webhook_duration_seconds", "Время ответа на вебхук", ["bot"])
+UPDATE_SECONDS = REGISTRY.histogram("update_processing_seconds", "Время обработки одного апдейта", ["bot"])
+WEBHOOK_ERRORS = REGISTRY.counter("webhook_errors_total", "Вебхуки, завершившиеся ошибкой", ["bot"])
+REGISTRY.register_stats("dedup", message_dedup.stats, bot="whatsapp")
+REGISTRY.register_stats("ingest", update_workers.stats, bot="whatsapp")
+REGISTRY.register_stats("outbound", graph_outbound.stats, api="whatsapp")
+REGISTRY.register_stats("message_archive", message_archive.stats, bot="whatsapp")
+REGISTRY.register_stats("message_writer", message_writer.stats, bot="whatsapp")
 
+# --- РАБОТА С БАЗОЙ ДАННЫХ ---
+# Соединения берутся из общего пула (db.py), а не открываются на каждый вызов.
 def init_db():
-    """Создает таблицы в базе данных, если их нет."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS clients (
-            id SERIAL PRIMARY KEY,
-            phone_number VARCHAR(50) UNIQUE NOT NULL,
-            name VARCHAR(100),
-            status VARCHAR(50) DEFAULT 'new',
-            managed_by_manager BOOLEAN DEFAULT FALSE,
-            dialog_step VARCHAR(50) DEFAULT 'start',
-            budget VARCHAR(100),
-            car_type VARCHAR(100)
-        );
-    ''')
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id SERIAL PRIMARY KEY,
-            client_id INTEGER REFERENCES clients(id),
-            message_text TEXT,
-            sender_is_bot BOOLEAN,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    ''')
-    conn.commit()
-    cur.close()
-    conn.close()
+    """Применяет недостающие миграции схемы (см. migrations.init_schema)."""
+    return init_schema("whatsapp", WHATSAPP_MIGRATIONS)
 
 # --- ДЕКОРАТОР ДЛЯ ПРОВЕРКИ ПОДПИСИ ---
 def validate_signature(f):
@@ -76,7 +123,7 @@ def validate_signature(f):
 
 # --- ЛОГИКА ОТПРАВКИ СООБЩЕНИЙ ---
 def send_text_message(text, phone_number):
-    """Отправляет простое текстовое сообщение."""
+    """Ставит простое текстовое сообщение в очередь отправки."""
     payload = json.dumps({
         "messaging_product": "whatsapp",
         "to": str(phone_number),
@@ -87,90 +134,129 @@ def send_text_message(text, phone_number):
         "Content-Type": "application/json",
         "Authorization": "Bearer " + ACCESS_TOKEN,
     }
-    try:
-        response = requests.post(GRAPH_API_URL, headers=headers, data=payload)
-        response.raise_for_status()
-        print(f"Сообщение успешно отправлено на номер {phone_number}")
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при отправке сообщения: {e}")
-        if e.response is not None:
-            print(f"Ответ сервера Meta: {e.response.text}")
+    graph_outbound.post_async(str(phone_number), GRAPH_API_URL, headers=headers, data=payload)
 
 # --- ЛОГИКА ОБРАБОТКИ ДИАЛОГА ---
-def process_chat_message(message_body, phone_number, name):
-    """Обрабатывает входящие сообщения и ведет диалог."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    # Находим или создаем клиента
-    cur.execute("SELECT id, dialog_step, managed_by_manager FROM clients WHERE phone_number = %s", (phone_number,))
-    client = cur.fetchone()
-    if not client:
-        cur.execute("INSERT INTO clients (phone_number, name) VALUES (%s, %s) RETURNING id, dialog_step, managed_by_manager", (phone_number, name))
-        client = cur.fetchone()
-    client_id, dialog_step, managed_by_manager = client
-
-    # Сохраняем сообщение клиента
-    cur.execute("INSERT INTO messages (client_id, message_text, sender_is_bot) VALUES (%s, %s, %s)",
-                (client_id, message_body, False))
-    conn.commit()
-
-    # Логика для менеджера (остается без изменений)
-    if phone_number == MANAGER_PHONE_NUMBER:
-        # ... (код для команд /takeover и /release) ...
-        cur.close()
-        conn.close()
-        return
-
-    # Если чатом управляет менеджер, пересылаем ему сообщение
-    if managed_by_manager:
-        manager_message = f"Сообщение от клиента {name} ({phone_number}):\n\n{message_body}"
-        send_text_message(manager_message, MANAGER_PHONE_NUMBER)
-        cur.close()
-        conn.close()
-        return
-    
-    # --- Логика пошагового диалога ---
-    user_input = message_body.lower().strip()
-    reply_text = ""
-
-    if dialog_step == 'start':
-        reply_text = f"Здравствуйте, {name}! Я помогу вам подобрать автомобиль из Кореи. Начнем? (Да/Нет)"
-        cur.execute("UPDATE clients SET dialog_step = 'ask_budget' WHERE id = %s", (client_id,))
-    
-    elif dialog_step == 'ask_budget':
-        if user_input == 'да':
-            reply_text = "Отлично! Какой у вас бюджет в долларах США? (например, 25000)"
-            cur.execute("UPDATE clients SET dialog_step = 'get_budget' WHERE id = %s", (client_id,))
-        else:
-            reply_text = "Хорошо, если передумаете, просто напишите мне."
-            cur.execute("UPDATE clients SET dialog_step = 'start' WHERE id = %s", (client_id,)) # Сброс
-    
-    elif dialog_step == 'get_budget':
-        if user_input.isdigit():
-            reply_text = "Принято. Какой тип кузова вас интересует? (например, Седан, Кроссовер, Внедорожник)"
-            cur.execute("UPDATE clients SET budget = %s, dialog_step = 'get_car_type' WHERE id = %s", (user_input, client_id))
+# Шаги сценария общие с Telegram (dialog.py), здесь только тексты канала.
+DIALOG_TEXTS = {
+    "greeting": "Здравствуйте, {name}! Я помогу вам подобрать автомобиль из Кореи. Начнем? (Да/Нет)",
+    "ask_budget": "Отлично! Какой у вас бюджет в долларах США? (например, 25000)",
+    "declined": "Хорошо, если передумаете, просто напишите мне.",
+    "ask_car_type": "Принято. Какой тип кузова вас интересует? (например, Седан, Кроссовер, Внедорожник)",
+    "budget_digits_only": "Пожалуйста, введите бюджет цифрами.",
+    "summary": "Спасибо! Ваш запрос записан:\n\n*Тип авто*: {message}\n*Бюджет*: до ${budget}\n\nНаш менеджер скоро с вами свяжется.",
+}
+client_dialog = Dialog(DIALOG_STEPS, DIALOG_TEXTS, channel="whatsapp")
+CLIENT_SAVE_ATTEMPTS = 3
+
+@timed(UPDATE_SECONDS, bot="whatsapp")
+def process_chat_messages(phone_number, name, message_bodies):
+    """Обрабатывает пачку входящих сообщений одного клиента и ведет диалог.
+
+    Сообщения проходят по сценарию по порядку, а сохраняются вместе с ответами
+    бота одним многострочным INSERT (save_turn).
+    """
+    outgoing = []
+    with db_cursor() as cur:
+        for _ in range(CLIENT_SAVE_ATTEMPTS):
+            # Находим или создаем клиента
+            client = dict(zip(("id", "dialog_step", "managed_by_manager", "budget"),
+                              upsert_client(cur, "clients", "phone_number", phone_number, name)))
+            state = dict(client)
+            updates, messages, outgoing = {}, [], []
+
+            for message_body in message_bodies:
+                messages.append((message_body, False))
+
+                # Логика для менеджера (остается без изменений)
+                if phone_number == MANAGER_PHONE_NUMBER:
+                    # ... (код для команд /takeover и /release) ...
+                    pass
+
+                # Если чатом управляет менеджер, пересылаем ему сообщение
+                elif client["managed_by_manager"]:
+                    manager_message = f"Сообщение от клиента {name} ({phone_number}):\n\n{message_body}"
+                    outgoing.append((manager_message, MANAGER_PHONE_NUMBER))
+
+                # --- Логика пошагового диалога ---
+                else:
+                    outcome = client_dialog.advance(state, message_body, name, phone_number)
+                    updates.update(outcome.updates)
+                    state.update(outcome.updates)
+                    if outcome.reply:
+                        outgoing.append((outcome.reply, phone_number))
+                        messages.append((outcome.reply, True))
+
+            # Сообщения клиента, ответы бота и новый шаг сохраняются одним запросом;
+            # проверка идет по состоянию, прочитанному до первого сообщения пачки
+            if save_turn(cur, "clients", "messages", client, updates, messages, message_writer):
+                break
         else:
-            reply_text = "Пожалуйста, введите бюджет цифрами."
-            
-    elif dialog_step == 'get_car_type':
-        cur.execute("SELECT budget FROM clients WHERE id = %s", (client_id,))
-        budget = cur.fetchone()[0]
-        reply_text = f"Спасибо! Ваш запрос записан:\n\n*Тип авто*: {message_body}\n*Бюджет*: до ${budget}\n\nНаш менеджер скоро с вами свяжется."
-        cur.execute("UPDATE clients SET car_type = %s, dialog_step = 'done', status = 'completed' WHERE id = %s", (message_body, client_id))
-
-    if reply_text:
-        send_text_message(reply_text, phone_number)
-        cur.execute("INSERT INTO messages (client_id, message_text, sender_is_bot) VALUES (%s, %s, %s)",
-                    (client_id, reply_text, True))
-
-    conn.commit()
-    cur.close()
-    conn.close()
+            print(f"Не удалось сохранить сообщения клиента {phone_number}: состояние меняется параллельно")
+            return
+
+    for text, recipient in outgoing:
+        send_text_message(text, recipient)
+
+def save_statuses(rows):
+    """Сохраняет статусы доставки одним многострочным INSERT; повторы игнорируются."""
+    with db_cursor() as cur:
+        execute_values(
+            cur,
+            "INSERT INTO message_statuses (message_id, recipient, status, status_timestamp, errors) VALUES %s "
+            "ON CONFLICT DO NOTHING",
+            rows, template="(%s, %s, %s, to_timestamp(%s::bigint), %s)", page_size=len(rows))
+
+def status_row(status):
+    """Строка message_statuses из статуса Meta; ValueError/KeyError, если статус неполный."""
+    timestamp = status.get('timestamp')
+    if timestamp is not None and not str(timestamp).isdigit():
+        raise ValueError(f"Некорректный timestamp статуса: {timestamp!r}")
+    return (status['id'], status.get('recipient_id'), status['status'], timestamp,
+            json.dumps(status['errors']) if status.get('errors') else None)
+
+def parse_webhook(request_body):
+    """Разбирает все entry/changes пакета Meta.
+
+    Возвращает ([(phone_number, name, [(message_id, text), ...]), ...], status_rows):
+    текстовые сообщения сгруппированы по отправителю с сохранением порядка,
+    статусы уже проверены и готовы к save_statuses.
+    """
+    senders = {}
+    statuses = []
+    for entry in request_body['entry']:
+        for change in entry.get('changes', []):
+            value = change.get('value', {})
+            names = {contact.get('wa_id'): contact.get('profile', {}).get('name')
+                     for contact in value.get('contacts', [])}
+            for message_data in value.get('messages', []):
+                if 'text' not in message_data:
+                    continue
+                phone_number = message_data['from']
+                # Без своего контакта имя неизвестно; имя другого отправителя пакета брать нельзя
+                name = names.get(phone_number) or phone_number
+                sender = senders.setdefault(phone_number, (phone_number, name, []))
+                sender[2].append((message_data.get('id'), message_data['text']['body']))
+            statuses.extend(status_row(status) for status in value.get('statuses', []))
+    return list(senders.values()), statuses
+
+def save_webhook_statuses(statuses):
+    """Сохраняет статусы пакета после его сообщений.
+
+    Если запись упадет и Meta повторит пакет, сообщения уже обработаны и верно
+    отсеются как повторы, а статусы запишутся заново (повторы игнорируются).
+    """
+    if statuses:
+        try:
+            save_statuses(statuses)
+        except Exception:
+            WEBHOOK_ERRORS.inc(bot="whatsapp")
+            raise
 
 # --- ОСНОВНОЙ ENDPOINT ---
 @app.route('/api/whatsapp', methods=['GET', 'POST'])
 @validate_signature
+@timed(WEBHOOK_SECONDS, bot="whatsapp")
 def whatsapp_endpoint():
     if request.method == 'GET':
         # ... (код верификации) ...
@@ -179,19 +265,50 @@ def whatsapp_endpoint():
     elif request.method == 'POST':
         request_body = request.get_json()
         try:
-            changes = request_body['entry'][0]['changes'][0]['value']
-            if 'messages' in changes:
-                message_data = changes['messages'][0]
-                if 'text' in message_data:
-                    phone_number = message_data['from']
-                    name = changes['contacts'][0]['profile']['name']
-                    message_body = message_data['text']['body']
-                    process_chat_message(message_body, phone_number, name)
-            return jsonify(status="ok"), 200
-        except (KeyError, IndexError) as e:
+            senders, statuses = parse_webhook(request_body)
+        except (KeyError, IndexError, TypeError, AttributeError, ValueError) as e:
             print(f"Ошибка обработки вебхука: {e}")
+            WEBHOOK_ERRORS.inc(bot="whatsapp")
             return jsonify(status="error", reason="malformed data"), 400
 
+        # Повторы всех сообщений пакета отсеиваются одним запросом
+        message_ids = [message_id for _, _, messages in senders for message_id, _ in messages if message_id]
+        new_ids = message_dedup.filter_new(message_ids) if message_ids else set()
+        batches = []
+        for phone_number, name, messages in senders:
+            fresh = [(message_id, body) for message_id, body in messages if not message_id or message_id in new_ids]
+            if fresh:
+                batches.append((phone_number, name, fresh))
+
+        if INGEST_MODE == 'queue':
+            # Отправители обрабатываются параллельно, сообщения одного номера — по порядку
+            for index, (phone_number, name, messages) in enumerate(batches):
+                bodies = [body for _, body in messages]
+                if not update_workers.submit(phone_number, process_chat_messages, phone_number, name, bodies):
+                    # Уже принятые пачки при повторе отсеются, остальные нужно пропустить
+                    message_dedup.forget_many(message_id for _, _, rest in batches[index:] for message_id, _ in rest if message_id)
+                    return jsonify(status="busy"), 503
+            save_webhook_statuses(statuses)
+            return jsonify(status="ok"), 200
+
+        for index, (phone_number, name, messages) in enumerate(batches):
+            try:
+                process_chat_messages(phone_number, name, [body for _, body in messages])
+            except Exception:
+                # Meta повторит доставку после ошибки — необработанные сообщения не должны отсеяться
+                WEBHOOK_ERRORS.inc(bot="whatsapp")
+                message_dedup.forget_many(message_id for _, _, rest in batches[index:] for message_id, _ in rest if message_id)
+                raise
+        save_webhook_statuses(statuses)
+        return jsonify(status="ok"), 200
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики процесса в текстовом формате Prometheus."""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return Response("forbidden\n", status=403, mimetype='text/plain')
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     init_db()
     app.run()
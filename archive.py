@@ -0,0 +1,246 @@
+import os
+import re
+import gzip
+import json
+import time
+import uuid
+import datetime
+import threading
+
+from psycopg2.extras import execute_values
+
+from cache import LRUCache
+from db import db_connection, db_cursor, mark_background_thread
+from export import json_default
+
+
+def _month_start(months_back=0):
+    today = datetime.date.today()
+    month_index = today.year * 12 + today.month - 1 - months_back
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+
+class MessageArchive:
+    """Обслуживание помесячных секций таблицы сообщений и архив холодных месяцев.
+
+    Фоновый поток раз в interval секунд создает секции на текущий и следующий
+    месяц, а секции старше hot_months месяцев (если задан directory) выгружает
+    в gzip JSONL на диск и удаляет из БД. Какие месяцы клиента лежат в архиве
+    и где в файле начинаются его строки, записано в таблице message_archive;
+    read() дочитывает из архива историю, которой уже нет в БД.
+    """
+
+    def __init__(self, table, directory=None, hot_months=6, interval=3600, cache_size=256):
+        self.table = table
+        self.directory = os.path.join(directory, table) if directory else None
+        self.hot_months = hot_months
+        self.interval = interval
+        # Архивные файлы не меняются, поэтому прочитанные срезы можно кэшировать бессрочно
+        self._slices = LRUCache(maxsize=cache_size, ttl=float("inf"))
+        self._partition_name = re.compile(rf"^{re.escape(table)}_p(\d{{4}})(\d{{2}})$")
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {"runs": 0, "archived_partitions": 0, "archived_rows": 0, "archive_reads": 0, "errors": 0}
+
+    # --- ФОНОВОЕ ОБСЛУЖИВАНИЕ ---
+    def ensure_started(self):
+        """Запускает поток обслуживания в текущем процессе (после fork — заново)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._loop, name=f"archive-{self.table}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _loop(self):
+        mark_background_thread()
+        while True:
+            try:
+                self.run()
+            except Exception as e:
+                self._count("errors")
+                print(f"Ошибка обслуживания секций {self.table}: {e}")
+            time.sleep(self.interval)
+
+    def run(self):
+        """Один проход обслуживания. Возвращает список выгруженных секций.
+
+        Воркеров много, а проход нужен один: его выполняет тот, кто взял
+        advisory-блокировку, остальные пропускают.
+        """
+        lock_key = f"archive:{self.table}"
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_try_advisory_lock(hashtext(%s));", (lock_key,))
+            if not cur.fetchone()[0]:
+                return []
+            try:
+                self._count("runs")
+                for months_ahead in (0, 1):
+                    cur.execute("SELECT create_monthly_partition(%s, %s);", (self.table, _month_start(-months_ahead)))
+                # Строки, попавшие в секцию по умолчанию (обслуживание не работало), переносятся в свои месяцы
+                cur.execute(
+                    f"SELECT create_monthly_partition(%s, month::date) FROM "
+                    f"(SELECT DISTINCT date_trunc('month', timestamp) AS month FROM {self.table}_default) AS months;",
+                    (self.table,)
+                )
+                conn.commit()
+                archived = []
+                if self.directory:
+                    for partition, month in self.cold_partitions(cur):
+                        self.archive_partition(conn, partition, month)
+                        archived.append(partition)
+                return archived
+            finally:
+                conn.rollback()
+                cur.execute("SELECT pg_advisory_unlock(hashtext(%s));", (lock_key,))
+
+    def cold_partitions(self, cur):
+        """Секции месяцев раньше горячего окна, от старых к новым."""
+        cur.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass;", (self.table,)
+        )
+        cutoff = _month_start(self.hot_months)
+        partitions = []
+        for (name,) in cur.fetchall():
+            match = self._partition_name.match(name)
+            if match:
+                month = datetime.date(int(match.group(1)), int(match.group(2)), 1)
+                if month < cutoff:
+                    partitions.append((name, month))
+        return sorted(partitions, key=lambda item: item[1])
+
+    def path(self, month):
+        return os.path.join(self.directory, f"{month:%Y-%m}.jsonl.gz")
+
+    def archive_partition(self, conn, partition, month):
+        """Выгружает секцию в файл, записывает каталог и удаляет секцию одной транзакцией.
+
+        Строки каждого клиента сжимаются отдельным gzip-потоком (member): файл
+        целиком остается обычным gzip, а историю одного клиента можно прочитать
+        по смещению из каталога, не распаковывая остальных.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(month)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        rows = 0
+        # client_id -> [first_id, last_id, messages, file_offset, file_length]
+        clients = {}
+        try:
+            with conn.cursor(name=f"archive_{uuid.uuid4().hex}") as cur, open(tmp_path, "wb") as f:
+                cur.itersize = 5000
+                cur.execute(f"SELECT * FROM {partition} ORDER BY client_id, id;")
+                columns, member, current = None, None, None
+                for row in cur:
+                    if columns is None:
+                        columns = [column.name for column in cur.description]
+                    record = dict(zip(columns, row))
+                    if member is None or record["client_id"] != current:
+                        if member is not None:
+                            member.close()
+                            clients[current][4] = f.tell() - clients[current][3]
+                        current = record["client_id"]
+                        clients[current] = [record["id"], record["id"], 0, f.tell(), None]
+                        member = gzip.GzipFile(fileobj=f, mode="wb")
+                    member.write((json.dumps(record, ensure_ascii=False, default=json_default) + "\n").encode("utf-8"))
+                    clients[current][1] = record["id"]
+                    clients[current][2] += 1
+                    rows += 1
+                if member is not None:
+                    member.close()
+                    clients[current][4] = f.tell() - clients[current][3]
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        cur = conn.cursor()
+        execute_values(
+            cur,
+            "INSERT INTO message_archive (parent, month, client_id, first_id, last_id, messages, file_offset, file_length) "
+            "VALUES %s ON CONFLICT (parent, client_id, month) DO UPDATE SET "
+            "first_id = EXCLUDED.first_id, last_id = EXCLUDED.last_id, messages = EXCLUDED.messages, "
+            "file_offset = EXCLUDED.file_offset, file_length = EXCLUDED.file_length;",
+            [(self.table, month, client_id, *entry) for client_id, entry in clients.items() if client_id is not None],
+        )
+        cur.execute(f"ALTER TABLE {self.table} DETACH PARTITION {partition};")
+        cur.execute(f"DROP TABLE {partition};")
+        conn.commit()
+        self._count("archived_partitions")
+        self._count("archived_rows", rows)
+        print(f"Секция {partition} выгружена в архив: {path} ({rows} строк)")
+
+    # --- ЧТЕНИЕ АРХИВА ---
+    def read(self, client_id, before_id, limit):
+        """До limit архивных сообщений клиента с id < before_id, от новых к старым."""
+        if not self.directory or limit <= 0:
+            return []
+        with db_cursor() as cur:
+            cur.execute(
+                "SELECT month, file_offset, file_length FROM message_archive WHERE parent = %s AND client_id = %s "
+                "AND (%s::int IS NULL OR first_id < %s) ORDER BY month DESC;",
+                (self.table, client_id, before_id, before_id)
+            )
+            months = cur.fetchall()
+        result = []
+        for month, offset, length in months:
+            rows = [row for row in self._client_rows(month, client_id, offset, length)
+                    if before_id is None or row["id"] < before_id]
+            result.extend(reversed(rows))
+            if len(result) >= limit:
+                break
+        return result[:limit]
+
+    def _client_rows(self, month, client_id, offset=None, length=None):
+        key = (month, client_id)
+        rows = self._slices.get(key)
+        if rows is None:
+            self._count("archive_reads")
+            try:
+                if offset is not None:
+                    rows = self._read_member(month, offset, length)
+                else:
+                    rows = self._scan(month, client_id)
+            except FileNotFoundError:
+                print(f"Нет файла архива {self.path(month)}")
+                rows = []
+            for row in rows:
+                row["timestamp"] = datetime.datetime.fromisoformat(row["timestamp"])
+            self._slices.set(key, rows)
+        return rows
+
+    def _read_member(self, month, offset, length):
+        """Строки клиента из его gzip-потока по смещению из каталога."""
+        with open(self.path(month), "rb") as f:
+            f.seek(offset)
+            data = gzip.decompress(f.read(length))
+        return [json.loads(line) for line in data.decode("utf-8").splitlines()]
+
+    def _scan(self, month, client_id):
+        """Файлы, выгруженные до появления смещений: чтение с начала до строк клиента.
+
+        Строки отсортированы по клиенту, поэтому чтение останавливается, как
+        только строки клиента закончились.
+        """
+        rows = []
+        with gzip.open(self.path(month), "rt", encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                if row["client_id"] == client_id:
+                    rows.append(row)
+                elif rows:
+                    break
+        return rows
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
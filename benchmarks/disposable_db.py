@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import subprocess
+
+import psycopg2
+from psycopg2.extensions import make_dsn
+
+
+class DisposableDatabase:
+    """Одноразовая база Postgres для бенчмарка, удаляется по выходу из with.
+
+    С admin_url создается временная база на уже запущенном сервере. Без него
+    поднимается собственный кластер через initdb/pg_ctl из PATH во временном
+    каталоге (соединения только через unix-сокет).
+    """
+
+    def __init__(self, admin_url=None):
+        self.admin_url = admin_url
+        self.url = None
+        self._name = f"rsapp_bench_{os.getpid()}"
+        self._datadir = None
+
+    def __enter__(self):
+        if self.admin_url:
+            self._admin(f"DROP DATABASE IF EXISTS {self._name};")
+            self._admin(f"CREATE DATABASE {self._name};")
+            self.url = make_dsn(self.admin_url, dbname=self._name)
+        else:
+            self._start_cluster()
+        return self
+
+    def __exit__(self, *exc):
+        if self.admin_url:
+            self._admin(f"DROP DATABASE IF EXISTS {self._name} WITH (FORCE);")
+        elif self._datadir:
+            subprocess.run(["pg_ctl", "-D", self._datadir, "-m", "immediate", "-w", "stop"],
+                           check=False, capture_output=True)
+            shutil.rmtree(self._datadir, ignore_errors=True)
+
+    def _admin(self, sql):
+        conn = psycopg2.connect(self.admin_url)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql)
+        finally:
+            conn.close()
+
+    def _start_cluster(self):
+        if not shutil.which("initdb") or not shutil.which("pg_ctl"):
+            raise SystemExit("Нет initdb/pg_ctl в PATH: укажите BENCH_ADMIN_URL на существующий сервер Postgres")
+        self._datadir = tempfile.mkdtemp(prefix="rsapp-bench-pg-")
+        subprocess.run(["initdb", "-D", self._datadir, "-U", "postgres", "-A", "trust", "--no-sync"],
+                       check=True, capture_output=True)
+        subprocess.run(["pg_ctl", "-D", self._datadir, "-w", "-l", os.path.join(self._datadir, "server.log"),
+                        "-o", f"-k {self._datadir} -c listen_addresses=''", "start"],
+                       check=True, capture_output=True)
+        self.url = make_dsn(dbname="postgres", user="postgres", host=self._datadir)
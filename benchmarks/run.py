@@ -0,0 +1,349 @@
+"""Бенчмарк вебхуков и API дашборда на синтетическом потоке апдейтов.
+
+    BENCH_ADMIN_URL=postgresql://postgres@localhost/postgres python benchmarks/run.py
+    python benchmarks/run.py --updates 5000 --concurrency 16 --scenario telegram_text
+    python benchmarks/run.py --save-baseline      # запомнить результат как эталон
+
+Приложения запускаются в этом же процессе через Flask test client, API Telegram
+и WhatsApp заменены локальной заглушкой (stub_api.py), база одноразовая
+(disposable_db.py). Для каждого сценария выводятся p50/p95/p99, RPS, запросы
+к БД на апдейт и память процесса. Результат пишется в benchmarks/results/ и
+сравнивается с benchmarks/baseline.json: при ухудшении больше допуска
+скрипт завершается с кодом 1.
+"""
+import os
+import sys
+import json
+import hmac
+import math
+import time
+import random
+import hashlib
+import argparse
+import platform
+import resource
+import subprocess
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from stub_api import StubApi
+from disposable_db import DisposableDatabase
+
+BOT_TOKEN = "123456:bench"
+MANAGER_CHAT_ID = "1"
+APP_SECRET = "bench-secret"
+MANAGER_PHONE = "70000000000"
+
+SCENARIOS = ["telegram_text", "telegram_voice", "telegram_webapp", "whatsapp_batch", "clients_api"]
+
+
+# --- ГЕНЕРАТОРЫ НАГРУЗКИ ---
+# Сценарий — генератор раундов: раунд это список запросов, которые можно
+# выполнять параллельно; следующий раунд начинается, когда закончен текущий
+# (так шаги диалога одного клиента не обгоняют друг друга). В генератор
+# возвращаются ответы раунда.
+
+def _request(target, path, method="POST", updates=1, **kwargs):
+    return {"target": target, "path": path, "method": method, "updates": updates, "kwargs": kwargs}
+
+
+class UpdateIds:
+    def __init__(self):
+        self.value = 0
+
+    def next(self):
+        self.value += 1
+        return self.value
+
+
+def _tg_update(ids, chat_id, **message):
+    message.setdefault("from", {"first_name": f"Bench{chat_id}"})
+    message["chat"] = {"id": chat_id}
+    return {"update_id": ids.next(), "message": message}
+
+
+def telegram_text(ctx, n):
+    chats = [10_000 + i for i in range(max(1, n // 4))]
+    for text in ["Привет", "Да", "25000", "Седан"]:
+        yield [_request("tg", "/webhook", json=_tg_update(ctx["ids"], chat, text=text)) for chat in chats]
+
+
+def telegram_voice(ctx, n):
+    voice = {"file_id": "stub-file", "file_unique_id": "stub-unique", "duration": 3}
+    yield [_request("tg", "/webhook", json=_tg_update(ctx["ids"], 20_000 + i % max(1, n // 2), voice=voice))
+           for i in range(n)]
+
+
+def telegram_webapp(ctx, n):
+    chats = [10_000 + i for i in range(max(1, n // 4))]
+    rnd = random.Random(1)
+    yield [_request("tg", "/webhook", json=_tg_update(
+        ctx["ids"], int(MANAGER_CHAT_ID),
+        web_app_data={"data": json.dumps({"action": "get_history", "chat_id": str(rnd.choice(chats))})}))
+        for _ in range(max(1, n // 10))]
+
+
+def _wa_payload(batch, statuses):
+    messages = [{"id": f"wamid.bench.{message_id}", "from": phone, "type": "text", "text": {"body": text},
+                 "timestamp": str(int(time.time()))} for message_id, phone, text in batch]
+    contacts = [{"wa_id": phone, "profile": {"name": f"Bench{phone}"}} for phone in {phone for _, phone, _ in batch}]
+    body = json.dumps({"object": "whatsapp_business_account", "entry": [{"id": "bench", "changes": [
+        {"field": "messages", "value": {"contacts": contacts, "messages": messages, "statuses": statuses}}]}]}).encode()
+    signature = "sha256=" + hmac.new(APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return body, signature
+
+
+def whatsapp_batch(ctx, n, senders_per_payload=5):
+    # Каждый отправитель присылает по два сообщения в пакете, как при плотной пачке от Meta
+    phones = [str(79_000_000_000 + i) for i in range(max(senders_per_payload, n // 4))]
+    for round_texts in (["Привет", "да"], ["25000", "Кроссовер"]):
+        requests = []
+        for start in range(0, len(phones), senders_per_payload):
+            group = phones[start:start + senders_per_payload]
+            batch = [(ctx["ids"].next(), phone, text) for phone in group for text in round_texts]
+            statuses = [{"id": f"wamid.out.{ctx['ids'].next()}", "recipient_id": phone, "status": "delivered",
+                         "timestamp": str(int(time.time()))} for phone in group]
+            body, signature = _wa_payload(batch, statuses)
+            requests.append(_request("wa", "/api/whatsapp", updates=len(batch), data=body, headers={
+                "Content-Type": "application/json", "X-Hub-Signature-256": signature}))
+        yield requests
+
+
+def _init_data(user_id):
+    fields = {"auth_date": str(int(time.time())), "query_id": "bench",
+              "user": json.dumps({"id": int(user_id), "first_name": "Manager"}, separators=(",", ":"))}
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return "&".join(f"{key}={quote(value)}" for key, value in fields.items())
+
+
+def clients_api(ctx, n):
+    auth = {"Authorization": "tma " + _init_data(MANAGER_CHAT_ID)}
+    rnd = random.Random(2)
+    paths = []
+    for _ in range(max(1, n // 10)):
+        choice = rnd.random()
+        if choice < 0.5:
+            paths.append("/api/clients?limit=50")
+        elif choice < 0.8:
+            paths.append(f"/api/clients?limit=50&status={rnd.choice(['new', 'completed'])}")
+        else:
+            paths.append(f"/api/clients?limit=50&q=Bench1{rnd.randint(0, 99)}")
+    responses = yield [_request("tg", path, method="GET", headers=auth) for path in paths]
+    # Повтор тех же страниц с If-None-Match: так дашборд опрашивает список
+    yield [_request("tg", path, method="GET", headers={**auth, "If-None-Match": response.headers.get("ETag", "")})
+           for path, response in zip(paths, responses)]
+
+
+# --- ИЗМЕРЕНИЕ ---
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def rss_mb():
+    """Текущий RSS процесса (Linux), иначе пиковый."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def wait_outbound(clients, timeout=120):
+    """Ждет, пока фоновые очереди исходящих разошлют все принятые сообщения."""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        pending = 0
+        for client in clients:
+            queue = client.stats()["queue"]
+            pending += queue["submitted"] - queue["completed"] - queue["failed"]
+        if pending <= 0:
+            break
+        time.sleep(0.02)
+    return time.perf_counter() - started
+
+
+def run_scenario(name, generator, apps, concurrency, outbound, db):
+    def call(request):
+        client = apps[request["target"]].test_client()
+        started = time.perf_counter()
+        response = client.open(request["path"], method=request["method"], **request["kwargs"])
+        return time.perf_counter() - started, response
+
+    latencies, errors, updates = [], 0, 0
+    statements_before = db.statement_count()
+    all_statements_before = db.statement_count(include_background=True)
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        responses = None
+        while True:
+            try:
+                batch = generator.send(responses) if responses is not None else next(generator)
+            except StopIteration:
+                break
+            results = list(executor.map(call, batch))
+            responses = []
+            for request, (latency, response) in zip(batch, results):
+                latencies.append(latency)
+                updates += request["updates"]
+                if response.status_code >= 400:
+                    errors += 1
+                responses.append(response)
+    seconds = time.perf_counter() - started
+    statements = db.statement_count() - statements_before
+    background = db.statement_count(include_background=True) - all_statements_before - statements
+    drain = wait_outbound(outbound)
+
+    return {
+        "requests": len(latencies),
+        "updates": updates,
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "rps": round(len(latencies) / seconds, 1) if seconds else None,
+        "updates_per_second": round(updates / seconds, 1) if seconds else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+        "queries_per_update": round(statements / updates, 2) if updates else None,
+        "background_queries": background,
+        "outbound_drain_seconds": round(drain, 3),
+        "rss_mb": round(rss_mb(), 1),
+        "rss_growth_mb": round(rss_mb() - rss_before, 1),
+    }
+
+
+# --- СРАВНЕНИЕ С ЭТАЛОНОМ ---
+# (метрика, True если больше — хуже)
+COMPARED_METRICS = [("p99_ms", True), ("p50_ms", True), ("rps", False), ("queries_per_update", True)]
+
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for name, current in result["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        for metric, higher_is_worse in COMPARED_METRICS:
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            # Число запросов к БД детерминировано, любое увеличение — регрессия
+            limit = 0.0 if metric == "queries_per_update" else tolerance
+            if (change > limit) if higher_is_worse else (-change > limit):
+                regressions.append(f"{name}.{metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure_environment(args, database_url, api_base):
+    """Переменные окружения для ботов; выставляются до их импорта."""
+    os.environ.update({
+        "DATABASE_URL": database_url,
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "MANAGER_CHAT_IDS": MANAGER_CHAT_ID,
+        "MANAGER_PASSWORD": "bench",
+        "APP_SECRET": APP_SECRET,
+        "PHONE_NUMBER_ID": "1",
+        "ACCESS_TOKEN": "bench",
+        "MANAGER_PHONE_NUMBER": MANAGER_PHONE,
+        "TELEGRAM_API_BASE": api_base,
+        "GRAPH_API_BASE": api_base,
+        "INGEST_MODE": args.ingest_mode,
+        "MESSAGE_DURABILITY": args.durability,
+        "DB_POOL_MAX": str(max(10, args.concurrency + 4)),
+        # Лимиты платформ не должны искажать замер: заглушка их не проверяет
+        "TELEGRAM_GLOBAL_RATE": "100000",
+        "TELEGRAM_CHAT_RATE": "100000",
+        "GRAPH_GLOBAL_RATE": "100000",
+        # queries_per_update сравнивается без допуска: запросы по таймерам и счетчикам
+        # в замер попадать не должны (фоновые потоки statement_count() не считает)
+        "DEDUP_CLEANUP_EVERY": "0",
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--updates", type=int, default=2000, help="размер потока апдейтов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=8, help="число параллельных запросов")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="запустить только эти сценарии")
+    parser.add_argument("--ingest-mode", choices=["sync", "queue"], default="sync")
+    parser.add_argument("--durability", choices=["sync", "group", "async"], default="sync",
+                        help="режим записи сообщений (MESSAGE_DURABILITY)")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="задержка ответа заглушки API, мс")
+    parser.add_argument("--admin-url", default=os.environ.get("BENCH_ADMIN_URL"),
+                        help="сервер Postgres для временной базы (иначе свой кластер через initdb)")
+    parser.add_argument("--baseline", default=os.path.join(BENCH_DIR, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение метрик (доля)")
+    args = parser.parse_args()
+
+    with DisposableDatabase(args.admin_url) as database, StubApi(latency=args.stub_latency / 1000) as stub:
+        configure_environment(args, database.url, stub.base_url)
+        import db
+        import telegram_bot
+        import app as whatsapp_app
+        telegram_bot.init_db()
+        whatsapp_app.init_db()
+
+        apps = {"tg": telegram_bot.app, "wa": whatsapp_app.app}
+        outbound = [telegram_bot.telegram_outbound, whatsapp_app.graph_outbound]
+        ctx = {"ids": UpdateIds()}
+        result = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "settings": {"updates": args.updates, "concurrency": args.concurrency,
+                         "ingest_mode": args.ingest_mode, "stub_latency_ms": args.stub_latency},
+            "scenarios": {},
+        }
+        for name in args.scenario or SCENARIOS:
+            generator = globals()[name](ctx, args.updates)
+            stats = run_scenario(name, generator, apps, args.concurrency, outbound, db)
+            result["scenarios"][name] = stats
+            print(f"{name:16} {stats['requests']:6} запр. {stats['rps']:8} rps  p50 {stats['p50_ms']:7} мс  "
+                  f"p99 {stats['p99_ms']:7} мс  {stats['queries_per_update']} запр. БД/апдейт  "
+                  f"ошибок {stats['errors']}  RSS {stats['rss_mb']} МБ")
+        result["rss_peak_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        result["stub_calls"] = dict(stub.calls)
+
+    results_dir = os.path.join(BENCH_DIR, "results")
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(path, "w") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Результат сохранен: {path}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Эталон обновлен: {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("Регрессии относительно эталона:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("Регрессий относительно эталона нет")
+
+
+if __name__ == "__main__":
+    main()
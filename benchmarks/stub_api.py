@@ -0,0 +1,74 @@
+import json
+import time
+import threading
+from collections import Counter
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+from werkzeug.wsgi import get_input_stream
+
+# Размер "голосового", которое отдает заглушка при скачивании файла
+VOICE_BYTES = b"\x00" * (32 * 1024)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class StubApi:
+    """Локальная заглушка Telegram Bot API и WhatsApp Cloud API.
+
+    Отвечает успехом на любой метод, отдает файл для getFile и считает вызовы.
+    latency — искусственная задержка ответа в секундах (имитация сети).
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = make_server(host, port, self, threaded=True, request_handler=QuietRequestHandler)
+        self.base_url = f"http://{host}:{self._server.server_port}"
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-api", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        # Тело читается целиком, как это сделал бы настоящий API (важно для потоковых загрузок)
+        stream = get_input_stream(environ)
+        while stream.read(64 * 1024):
+            pass
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path.startswith("/file/"):
+            self._count("download")
+            start_response("200 OK", [("Content-Type", "audio/ogg"), ("Content-Length", str(len(VOICE_BYTES)))])
+            return [VOICE_BYTES]
+
+        method = path.rsplit("/", 1)[-1]
+        self._count(method)
+        if method == "getFile":
+            result = {"file_id": "stub", "file_path": "voice/stub.ogg"}
+        elif method == "messages":
+            body = json.dumps({"messages": [{"id": "wamid.stub"}]}).encode()
+            start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+            return [body]
+        else:
+            result = {"message_id": 1}
+        body = json.dumps({"ok": True, "result": result}).encode()
+        start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+        return [body]
+
+    def _count(self, method):
+        with self._lock:
+            self.calls[method] += 1
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
@@ -0,0 +1,250 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2.extras import Json, execute_values
+
+from db import DATABASE_URL, BROKEN_CONNECTION_ERRORS, db_cursor, mark_background_thread, on_commit
+from metrics import REGISTRY
+from outbound import TokenBucket
+
+CAMPAIGN_MESSAGES = REGISTRY.counter("campaign_messages_total", "Сообщения рассылок по результату", ["result"])
+
+CAMPAIGN_ACTIONS = {
+    "pause": (["running"], "paused"),
+    "resume": (["paused"], "running"),
+    "cancel": (["running", "paused"], "cancelled"),
+}
+
+
+def target_conditions(filters):
+    """Условия отбора получателей из tg_clients по фильтрам рассылки.
+
+    filters: status, car_type (без учета регистра), budget_min и budget_max
+    (бюджет хранится строкой из цифр, клиенты без бюджета в диапазон не попадают).
+    """
+    conditions, params = [], []
+    if filters.get("status"):
+        conditions.append("status = %s")
+        params.append(filters["status"])
+    if filters.get("car_type"):
+        conditions.append("lower(car_type) = lower(%s)")
+        params.append(filters["car_type"])
+    budget = "(CASE WHEN budget ~ '^[0-9]{1,15}$' THEN budget::bigint END)"
+    if filters.get("budget_min") is not None:
+        conditions.append(f"{budget} >= %s")
+        params.append(int(filters["budget_min"]))
+    if filters.get("budget_max") is not None:
+        conditions.append(f"{budget} <= %s")
+        params.append(int(filters["budget_max"]))
+    return " AND ".join(conditions) or "TRUE", params
+
+
+def count_targets(cur, filters):
+    where, params = target_conditions(filters)
+    cur.execute(f"SELECT count(*) FROM tg_clients WHERE {where};", params)
+    return cur.fetchone()[0]
+
+
+def create_campaign(cur, text, filters, created_by=None):
+    """Создает рассылку и фиксирует список получателей на момент создания.
+
+    Возвращает (id рассылки, число получателей).
+    """
+    where, params = target_conditions(filters)
+    cur.execute(
+        "INSERT INTO campaigns (message_text, filters, created_by) VALUES (%s, %s, %s) RETURNING id;",
+        (text, Json(filters), created_by)
+    )
+    campaign_id = cur.fetchone()[0]
+    cur.execute(
+        "INSERT INTO campaign_recipients (campaign_id, client_id, chat_id) "
+        f"SELECT %s, id, chat_id FROM tg_clients WHERE {where};", [campaign_id] + params
+    )
+    total = cur.rowcount
+    cur.execute("UPDATE campaigns SET total = %s WHERE id = %s;", (total, campaign_id))
+    return campaign_id, total
+
+
+def list_campaigns(cur, limit=50):
+    cur.execute(
+        "SELECT id, message_text, filters, status, created_by, created_at, finished_at, total, sent, failed "
+        "FROM campaigns ORDER BY id DESC LIMIT %s;", (limit,)
+    )
+    columns = [column.name for column in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def change_campaign_status(cur, campaign_id, action):
+    """pause/resume/cancel. Возвращает False, если рассылка не в подходящем статусе."""
+    allowed, new = CAMPAIGN_ACTIONS[action]
+    cur.execute(
+        "UPDATE campaigns SET status = %s, finished_at = CASE WHEN %s = 'cancelled' THEN now() END "
+        "WHERE id = %s AND status = ANY(%s);", (new, new, campaign_id, allowed)
+    )
+    return cur.rowcount == 1
+
+
+class CampaignRunner:
+    """Фоновая отправка рассылок с прогрессом в campaign_recipients.
+
+    Поток в каждом воркере раз в interval секунд ищет активные рассылки и
+    отправляет получателей пачками по batch_size. Пачку шлет только процесс,
+    взявший advisory-блокировку, так что общий темп рассылки (rate) не
+    умножается на число воркеров. Блокировка сессионная и держится на своем
+    соединении вне пула: отправка пачки с повторами может идти минутами, и
+    ни транзакция, ни соединение пула на это время не заняты. Получатели
+    выбираются одной короткой транзакцией, результаты пишутся второй; если
+    процесс упал между ними, пачка после перезапуска отправляется снова, так
+    что повтор возможен не больше чем для batch_size сообщений. С writer
+    (writer.py) отправленное попадает в историю чата общей пачкой сообщений.
+    """
+
+    def __init__(self, outbound, api_url, rate=25, batch_size=100, workers=16, interval=5, writer=None):
+        self.outbound = outbound
+        self.writer = writer
+        self.api_url = api_url
+        self.batch_size = batch_size
+        self.workers = workers
+        self.interval = interval
+        # Рассылка делит лимит бота с ответами клиентам, поэтому ее темп ниже лимита Telegram.
+        # Это ведро заменяет долю процесса в общем лимите outbound: рассылку шлет только
+        # процесс с advisory-блокировкой, и доля одного воркера ограничила бы ее темп.
+        self._bucket = TokenBucket(rate)
+        self._executor = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {"batches": 0, "sent": 0, "failed": 0, "errors": 0}
+
+    # --- ФОНОВЫЙ ПОТОК ---
+    def ensure_started(self):
+        """Запускает поток рассылки в текущем процессе (после fork — заново)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="campaign-send")
+            # Соединение, унаследованное через fork, принадлежит родителю
+            self._conn = None
+            threading.Thread(target=self._loop, name="campaigns", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _loop(self):
+        mark_background_thread()
+        while True:
+            try:
+                busy = self.run_once()
+            except Exception as e:
+                busy = False
+                self._count("errors")
+                print(f"Ошибка рассылки: {e}")
+            if not busy:
+                time.sleep(self.interval)
+
+    def run_once(self):
+        """Отправляет по пачке каждой активной рассылки. Возвращает True, если что-то отправлено."""
+        with db_cursor() as cur:
+            cur.execute("SELECT id, message_text FROM campaigns WHERE status = 'running' ORDER BY id;")
+            campaigns = cur.fetchall()
+        busy = False
+        for campaign_id, text in campaigns:
+            busy = self.send_batch(campaign_id, text) > 0 or busy
+        return busy
+
+    def send_batch(self, campaign_id, text):
+        conn = self._lock_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(hashtext('campaigns'));")
+                if not cur.fetchone()[0]:
+                    return 0
+        except BROKEN_CONNECTION_ERRORS:
+            self._conn = None
+            raise
+        try:
+            return self._send_locked(campaign_id, text)
+        finally:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(hashtext('campaigns'));")
+            except BROKEN_CONNECTION_ERRORS:
+                # Сессия оборвалась, и блокировка снялась вместе с ней
+                self._conn = None
+
+    def _lock_connection(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(DATABASE_URL)
+            self._conn.autocommit = True
+        return self._conn
+
+    def _send_locked(self, campaign_id, text):
+        with db_cursor() as cur:
+            cur.execute(
+                "SELECT client_id, chat_id FROM campaign_recipients "
+                "WHERE campaign_id = %s AND status = 'pending' ORDER BY client_id LIMIT %s;",
+                (campaign_id, self.batch_size)
+            )
+            recipients = cur.fetchall()
+            if not recipients:
+                cur.execute(
+                    "UPDATE campaigns SET status = 'completed', finished_at = now() "
+                    "WHERE id = %s AND status = 'running';", (campaign_id,)
+                )
+                return 0
+
+        results = list(self._executor.map(lambda recipient: self._send(recipient[1], text), recipients))
+        delivered = [client_id for (client_id, _), (status, _) in zip(recipients, results) if status == "sent"]
+        failed = len(recipients) - len(delivered)
+        with db_cursor() as cur:
+            execute_values(
+                cur,
+                "UPDATE campaign_recipients AS r SET status = v.status, message_id = v.message_id, sent_at = now() "
+                "FROM (VALUES %s) AS v (campaign_id, client_id, status, message_id) "
+                "WHERE r.campaign_id = v.campaign_id AND r.client_id = v.client_id;",
+                [(campaign_id, client_id, status, message_id)
+                 for (client_id, _), (status, message_id) in zip(recipients, results)],
+                template="(%s, %s, %s, %s::bigint)",
+            )
+            # Отправленное попадает в историю чата, как и сообщения менеджера
+            if delivered and self.writer is not None and self.writer.buffered:
+                on_commit(self.writer.write_committed, [self.writer.row(client_id=client_id, message_text=text, sender_is_bot=True)
+                                                        for client_id in delivered])
+            elif delivered:
+                execute_values(
+                    cur, "INSERT INTO tg_messages (client_id, message_text, sender_is_bot) VALUES %s;",
+                    [(client_id, text, True) for client_id in delivered]
+                )
+            cur.execute(
+                "UPDATE campaigns SET sent = sent + %s, failed = failed + %s WHERE id = %s;",
+                (len(delivered), failed, campaign_id)
+            )
+        self._count("batches")
+        self._count("sent", len(delivered))
+        self._count("failed", failed)
+        CAMPAIGN_MESSAGES.inc(len(delivered), result="sent")
+        CAMPAIGN_MESSAGES.inc(failed, result="failed")
+        return len(recipients)
+
+    def _send(self, chat_id, text):
+        """Отправляет одно сообщение. Возвращает (статус, message_id Telegram)."""
+        self._bucket.acquire()
+        response = self.outbound.post(chat_id, f"{self.api_url}/sendMessage", process_rate=False,
+                                      json={"chat_id": chat_id, "text": text})
+        if response is None:
+            return "failed", None
+        try:
+            return "sent", response.json()["result"]["message_id"]
+        except (ValueError, KeyError, TypeError):
+            return "sent", None
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,311 @@
+import os
+import re
+import time
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+from dotenv import load_dotenv
+
+from metrics import REGISTRY
+
+load_dotenv()
+
+# --- НАСТРОЙКИ ПУЛА ---
+# Пул создается заново в каждом процессе (воркере gunicorn) при первом обращении,
+# поэтому размеры задаются на один воркер: DB_POOL_MAX ≈ число потоков воркера.
+DATABASE_URL = os.environ.get("DATABASE_URL")
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))
+DB_HEALTHCHECK_INTERVAL = float(os.environ.get("DB_HEALTHCHECK_INTERVAL", "30"))
+
+# Ошибки, после которых соединение считается испорченным и не возвращается в пул
+BROKEN_CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+DB_STATEMENT_SECONDS = REGISTRY.histogram(
+    "db_statement_duration_seconds", "Время выполнения запроса к БД", ["statement"])
+
+_STATEMENT_TARGET = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+_SQL_COMMENT = re.compile(r"--[^\n]*")
+_statement_labels = {}
+
+
+def statement_label(query):
+    """Короткая метка запроса: команда и первая таблица ("INSERT tg_messages").
+
+    Тексты запросов в коде статичны, поэтому метки кэшируются; запросы с
+    переменным числом VALUES дают разные строки, и кэш ограничен по размеру.
+    """
+    label = _statement_labels.get(query)
+    if label is None:
+        text = query.decode(errors="replace") if isinstance(query, bytes) else str(query)
+        words = _SQL_COMMENT.sub("", text).split(None, 1)
+        target = _STATEMENT_TARGET.search(text)
+        label = f"{words[0].upper() if words else '?'} {target.group(1).lower() if target else '-'}"
+        if len(_statement_labels) < 1000:
+            _statement_labels[query] = label
+    return label
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Курсор, считающий выполненные запросы и время каждого (для метрик и бенчмарков)."""
+
+    def execute(self, query, vars=None):
+        _count_statement()
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            DB_STATEMENT_SECONDS.observe(time.perf_counter() - started, statement=statement_label(query))
+
+    def executemany(self, query, vars_list):
+        _count_statement()
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            DB_STATEMENT_SECONDS.observe(time.perf_counter() - started, statement=statement_label(query))
+
+
+_statements = 0
+_background_statements = 0
+_statements_lock = threading.Lock()
+_thread_state = threading.local()
+
+
+def _count_statement():
+    global _statements, _background_statements
+    background = getattr(_thread_state, "background", False)
+    with _statements_lock:
+        _statements += 1
+        if background:
+            _background_statements += 1
+
+
+def mark_background_thread():
+    """Отмечает текущий поток как фоновый (архив, рассылка, групповая запись).
+
+    Его запросы идут в общий счет, но не в statement_count(): их число зависит
+    от таймеров, а не от обработанных запросов.
+    """
+    _thread_state.background = True
+
+
+def statement_count(include_background=False):
+    """Сколько запросов выполнено в этом процессе с момента запуска (по умолчанию без фоновых потоков)."""
+    with _statements_lock:
+        return _statements if include_background else _statements - _background_statements
+
+
+class PoolTimeout(Exception):
+    """Не удалось дождаться свободного соединения за DB_POOL_TIMEOUT секунд."""
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с ожиданием, проверкой здоровья и метриками."""
+
+    def __init__(self, dsn, minconn, maxconn, timeout, healthcheck_interval):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, dsn, cursor_factory=CountingCursor)
+        # ThreadedConnectionPool при исчерпании сразу бросает PoolError,
+        # семафор превращает это в ожидание с таймаутом.
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._stats = {
+            "acquired": 0,
+            "in_use": 0,
+            "max_in_use": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "timeouts": 0,
+            "healthcheck_failures": 0,
+            "recycled": 0,
+        }
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolTimeout(f"Нет свободных соединений с БД за {self.timeout} с")
+        waited = time.monotonic() - started
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            stats = self._stats
+            stats["acquired"] += 1
+            stats["in_use"] += 1
+            stats["max_in_use"] = max(stats["max_in_use"], stats["in_use"])
+            stats["wait_seconds_total"] += waited
+            stats["wait_seconds_max"] = max(stats["wait_seconds_max"], waited)
+        return conn
+
+    def putconn(self, conn, broken=False):
+        broken = broken or conn.closed
+        if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except BROKEN_CONNECTION_ERRORS:
+                broken = True
+        with self._lock:
+            self._last_used.pop(id(conn), None)
+            if not broken:
+                self._last_used[id(conn)] = time.monotonic()
+            else:
+                self._stats["recycled"] += 1
+            self._stats["in_use"] -= 1
+        try:
+            self._pool.putconn(conn, close=broken)
+        finally:
+            self._slots.release()
+
+    def _checkout(self):
+        """Берет соединение из пула, заменяя мертвые и давно простаивавшие, но не отвечающие."""
+        conn = self._pool.getconn()
+        with self._lock:
+            last_used = self._last_used.get(id(conn))
+        if conn.closed:
+            healthy = False
+        elif last_used is None or time.monotonic() - last_used < self.healthcheck_interval:
+            healthy = True
+        else:
+            healthy = self._ping(conn)
+        if healthy:
+            return conn
+        with self._lock:
+            self._stats["healthcheck_failures"] += 1
+            self._stats["recycled"] += 1
+            self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+        return self._pool.getconn()
+
+    @staticmethod
+    def _ping(conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except BROKEN_CONNECTION_ERRORS:
+            return False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["max_size"] = self.maxconn
+        stats["statements"] = _statements
+        return stats
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Возвращает пул текущего процесса, создавая его при первом обращении (в т.ч. после fork)."""
+    global _pool, _pool_pid
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # Соединения, унаследованные от родителя через fork, не трогаем:
+            # их сокеты принадлежат другому процессу.
+            _pool = ConnectionPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX,
+                                   DB_POOL_TIMEOUT, DB_HEALTHCHECK_INTERVAL)
+            _pool_pid = os.getpid()
+    return _pool
+
+
+@contextmanager
+def db_connection():
+    """Выдает соединение из пула: коммит при успехе, откат при ошибке, замена при обрыве.
+
+    Функции, отложенные через on_commit() внутри блока, выполняются после
+    коммита, когда соединение уже вернулось в пул; при откате они отбрасываются.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    callbacks = []
+    stack = _commit_callbacks()
+    stack.append(callbacks)
+    try:
+        yield conn
+        conn.commit()
+    except BROKEN_CONNECTION_ERRORS:
+        broken = True
+        raise
+    except Exception:
+        try:
+            conn.rollback()
+        except BROKEN_CONNECTION_ERRORS:
+            broken = True
+        raise
+    finally:
+        stack.pop()
+        pool.putconn(conn, broken=broken)
+    for fn, args in callbacks:
+        fn(*args)
+
+
+def _commit_callbacks():
+    stack = getattr(_thread_state, "commit_callbacks", None)
+    if stack is None:
+        stack = _thread_state.commit_callbacks = []
+    return stack
+
+
+def on_commit(fn, *args):
+    """Откладывает fn(*args) до коммита текущей транзакции db_connection() этого потока.
+
+    Нужно для записи, которая идет через другое соединение и должна видеть
+    строки этой транзакции. Вне db_connection() fn выполняется сразу.
+    """
+    stack = _commit_callbacks()
+    if stack:
+        stack[-1].append((fn, args))
+    else:
+        fn(*args)
+
+
+@contextmanager
+def db_cursor():
+    """Курсор на соединении из пула; транзакция завершается при выходе из блока."""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+
+def close_pool():
+    """Закрывает пул текущего процесса (мастер gunicorn перед fork воркеров)."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool, _pool_pid = None, None
+
+
+def pool_stats():
+    """Метрики пула текущего процесса: ожидание, занятость, пересозданные соединения."""
+    if _pool is None or _pool_pid != os.getpid():
+        return {}
+    return _pool.stats()
+
+
+REGISTRY.register_stats("db_pool", pool_stats)
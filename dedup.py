@@ -0,0 +1,76 @@
+import threading
+
+from cache import LRUCache
+from db import db_cursor
+
+
+class Deduplicator:
+    """Отбрасывает повторные доставки апдейтов (update_id Telegram, id сообщения WhatsApp).
+
+    Сначала ключ ищется в LRU-кэше процесса — повтор, пришедший в тот же воркер,
+    отсекается без обращения к БД. Иначе ключ вставляется в processed_updates:
+    уникальный ключ таблицы ловит повторы, попавшие в другой воркер. Старые
+    ключи удаляются раз в cleanup_every принятых (0 — не удалять).
+    """
+
+    def __init__(self, source, cache_size=50000, retention_hours=48, cleanup_every=1000):
+        self.source = source
+        self.retention_hours = retention_hours
+        self.cleanup_every = cleanup_every
+        self._seen = LRUCache(maxsize=cache_size, ttl=retention_hours * 3600)
+        self._lock = threading.Lock()
+        self._stats = {"duplicates_memory": 0, "duplicates_db": 0, "accepted": 0}
+
+    def is_duplicate(self, key):
+        """Регистрирует ключ и возвращает True, если он уже обрабатывался."""
+        return str(key) not in self.filter_new([key])
+
+    def filter_new(self, keys):
+        """Регистрирует пачку ключей одним запросом и возвращает множество новых."""
+        keys = {str(key) for key in keys}
+        fresh = {key for key in keys if self._seen.get(key) is None}
+        self._count("duplicates_memory", len(keys) - len(fresh))
+        if not fresh:
+            return set()
+        with db_cursor() as cur:
+            cur.execute(
+                "INSERT INTO processed_updates (source, update_key) SELECT %s, unnest(%s::varchar[]) "
+                "ON CONFLICT DO NOTHING RETURNING update_key;",
+                (self.source, list(fresh))
+            )
+            new_keys = {row[0] for row in cur.fetchall()}
+            accepted = self._count("accepted", len(new_keys))
+            if new_keys and self.cleanup_every and accepted // self.cleanup_every != (accepted - len(new_keys)) // self.cleanup_every:
+                cur.execute(
+                    "DELETE FROM processed_updates WHERE source = %s AND received_at < NOW() - make_interval(hours => %s);",
+                    (self.source, self.retention_hours)
+                )
+        for key in fresh:
+            self._seen.set(key, True)
+        self._count("duplicates_db", len(fresh) - len(new_keys))
+        return new_keys
+
+    def forget(self, key):
+        """Снимает отметку, чтобы повторная доставка после ошибки обработки не потерялась."""
+        self.forget_many([key])
+
+    def forget_many(self, keys):
+        keys = [str(key) for key in keys]
+        if not keys:
+            return
+        for key in keys:
+            self._seen.invalidate(key)
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM processed_updates WHERE source = %s AND update_key = ANY(%s);",
+                        (self.source, keys))
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+            return self._stats[name]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["duplicates"] = stats["duplicates_memory"] + stats["duplicates_db"]
+        return stats
@@ -0,0 +1,178 @@
+from collections import namedtuple
+
+from db import on_commit
+from metrics import REGISTRY
+
+DIALOG_TRANSITIONS = REGISTRY.counter(
+    "dialog_transitions_total", "Шаги диалога с клиентом", ["channel", "from_step", "to_step"])
+
+# --- ОПИСАНИЕ ДИАЛОГА ---
+# Сценарий подбора авто общий для Telegram и WhatsApp. Каждый шаг задает
+# проверку ввода и два перехода: при успешной проверке (valid) и при неудачной
+# (invalid). Переход — это следующий шаг (None — остаться на месте), ключ текста
+# ответа, поле клиента, куда сохранить ввод, и доп. изменения строки клиента.
+# Тексты и клавиатуры у каждого канала свои, они подставляются при компиляции.
+
+Transition = namedtuple("Transition", "next_step reply keyboard save updates notify",
+                        defaults=(None, None, None, None, None, None))
+
+VALIDATORS = {
+    None: lambda user_input: True,
+    "yes": lambda user_input: user_input == "да",
+    "digits": lambda user_input: user_input.isdigit(),
+}
+
+DIALOG_STEPS = {
+    "start": {
+        "valid": Transition("ask_budget", reply="greeting", keyboard="yes_no"),
+    },
+    "ask_budget": {
+        "check": "yes",
+        "valid": Transition("get_budget", reply="ask_budget"),
+        "invalid": Transition("start", reply="declined"),
+    },
+    "get_budget": {
+        "check": "digits",
+        "valid": Transition("get_car_type", reply="ask_car_type", save=("budget", "input")),
+        "invalid": Transition(reply="budget_digits_only"),
+    },
+    "get_car_type": {
+        "valid": Transition("done", reply="summary", save=("car_type", "message"),
+                            updates={"status": "completed"}, notify="new_lead"),
+    },
+}
+
+# Поля клиента, которые может менять диалог (имена колонок подставляются в SQL)
+DIALOG_COLUMNS = frozenset({"dialog_step", "budget", "car_type", "status"})
+
+Outcome = namedtuple("Outcome", "reply keyboard updates notification")
+NO_OUTCOME = Outcome(None, None, {}, None)
+
+CompiledTransition = namedtuple("CompiledTransition", "next_step reply keyboard save updates notify")
+CompiledStep = namedtuple("CompiledStep", "check valid invalid")
+
+
+class Dialog:
+    """Скомпилированный сценарий одного канала: переходы и тексты разрешены заранее."""
+
+    def __init__(self, steps, texts, keyboards=None, channel=""):
+        self.channel = channel
+        keyboards = keyboards or {}
+        self._steps = {}
+        for name, spec in steps.items():
+            valid = self._compile(name, spec["valid"], texts, keyboards)
+            invalid = self._compile(name, spec["invalid"], texts, keyboards) if "invalid" in spec else valid
+            self._steps[name] = CompiledStep(VALIDATORS[spec.get("check")], valid, invalid)
+
+    @staticmethod
+    def _compile(step, transition, texts, keyboards):
+        updates = dict(transition.updates or {})
+        if transition.next_step and transition.next_step != step:
+            updates["dialog_step"] = transition.next_step
+        if transition.save:
+            updates[transition.save[0]] = None
+        unknown = set(updates) - DIALOG_COLUMNS
+        if unknown:
+            raise ValueError(f"Шаг {step} меняет неизвестные поля клиента: {unknown}")
+        return CompiledTransition(
+            transition.next_step,
+            texts[transition.reply] if transition.reply else None,
+            keyboards.get(transition.keyboard),
+            transition.save,
+            updates,
+            # Уведомление менеджеру есть не во всех каналах
+            texts.get(transition.notify) if transition.notify else None,
+        )
+
+    def advance(self, client, message_body, name, client_key):
+        """Выполняет один шаг диалога для клиента.
+
+        client — словарь с dialog_step и budget. Возвращает Outcome: текст ответа,
+        клавиатуру, изменения строки клиента (одной пачкой) и уведомление менеджеру.
+        """
+        step = self._steps.get(client["dialog_step"])
+        if step is None:
+            return NO_OUTCOME
+        user_input = message_body.lower().strip()
+        transition = step.valid if step.check(user_input) else step.invalid
+
+        # Шаг, сохранение которого не прошло проверку в save_turn, посчитается повторно
+        DIALOG_TRANSITIONS.inc(channel=self.channel, from_step=client["dialog_step"],
+                               to_step=transition.next_step or client["dialog_step"])
+        updates = dict(transition.updates)
+        if transition.save:
+            field, source = transition.save
+            updates[field] = user_input if source == "input" else message_body
+        values = {"name": name, "message": message_body, "client_key": client_key,
+                  "budget": updates.get("budget", client.get("budget"))}
+        reply = transition.reply.format(**values) if transition.reply else None
+        notification = transition.notify.format(**values) if transition.notify else None
+        return Outcome(reply, transition.keyboard, updates, notification)
+
+
+def upsert_client(cur, clients_table, key_column, key, name):
+    """Находит или создает клиента за один запрос; существующая строка не перезаписывается.
+
+    key_column — внешний идентификатор клиента в канале (chat_id, phone_number).
+    Возвращает (id, dialog_step, managed_by_manager, budget).
+    """
+    columns = "id, dialog_step, managed_by_manager, budget"
+    cur.execute(
+        f"WITH existing AS (SELECT {columns} FROM {clients_table} WHERE {key_column} = %s), "
+        f"inserted AS (INSERT INTO {clients_table} ({key_column}, name) SELECT %s, %s "
+        "WHERE NOT EXISTS (SELECT 1 FROM existing) "
+        f"ON CONFLICT ({key_column}) DO NOTHING RETURNING {columns}) "
+        "SELECT * FROM existing UNION ALL SELECT * FROM inserted;", (key, key, name))
+    row = cur.fetchone()
+    if not row:
+        # Клиента одновременно создал параллельный запрос, и наш снимок его еще не видел
+        cur.execute(f"SELECT {columns} FROM {clients_table} WHERE {key_column} = %s;", (key,))
+        row = cur.fetchone()
+    return row
+
+
+def save_turn(cur, clients_table, messages_table, client, updates, messages, writer=None):
+    """Одним запросом сохраняет изменения клиента и его сообщения.
+
+    messages — список пар (message_text, sender_is_bot). Запись выполняется, только
+    если dialog_step и managed_by_manager в БД совпадают с прочитанными ранее;
+    иначе возвращается False (строку успел изменить параллельный запрос).
+    writer — буферизованная запись сообщений (writer.py). Ход со сменой шага
+    целиком (проверка, UPDATE клиента и сообщения) выполняется в транзакции
+    пачки писателя и коммитится вместе с ходами других чатов; транзакция
+    вызывающего перед этим коммитится, иначе соединение писателя не увидит
+    созданного в ней клиента. Ход без смены шага проверяется в транзакции
+    вызывающего, а сообщения уходят в буфер после ее коммита.
+    """
+    if updates:
+        assignments = ", ".join(f"{column} = %s" for column in updates if column in DIALOG_COLUMNS)
+        guard = f"UPDATE {clients_table} SET {assignments} WHERE id = %s"
+        params = [value for column, value in updates.items() if column in DIALOG_COLUMNS]
+    else:
+        guard = f"SELECT id FROM {clients_table} WHERE id = %s"
+        params = []
+    guard += " AND dialog_step IS NOT DISTINCT FROM %s AND managed_by_manager IS NOT DISTINCT FROM %s"
+    if updates:
+        guard += " RETURNING id"
+    params += [client["id"], client["dialog_step"], client["managed_by_manager"]]
+    if writer is not None and writer.buffered and not updates:
+        cur.execute(guard + ";", params)
+        if cur.fetchone() is None:
+            return False
+        on_commit(writer.write_committed, [writer.row(client_id=client["id"], message_text=text,
+                                                      sender_is_bot=sender_is_bot)
+                                           for text, sender_is_bot in messages])
+        return True
+    for seq, (text, sender_is_bot) in enumerate(messages):
+        params += [seq, text, sender_is_bot]
+    values = ", ".join(["(%s, %s, %s)"] * len(messages))
+    query = (f"WITH guard AS ({guard}) "
+             f"INSERT INTO {messages_table} (client_id, message_text, sender_is_bot) "
+             "SELECT guard.id, v.message_text, v.sender_is_bot "
+             f"FROM guard, (VALUES {values}) AS v(seq, message_text, sender_is_bot) "
+             "ORDER BY v.seq;")
+    if writer is not None and writer.buffered:
+        cur.connection.commit()
+        return writer.execute(query, params, size=len(messages)) > 0
+    cur.execute(query, params)
+    return cur.rowcount > 0
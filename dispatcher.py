@@ -0,0 +1,133 @@
+import os
+import time
+import zlib
+import heapq
+import queue
+import atexit
+import itertools
+import threading
+
+from metrics import REGISTRY
+
+TASK_ERRORS = REGISTRY.counter("background_task_errors_total", "Фоновые задачи, завершившиеся исключением", ["pool"])
+
+
+class KeyedWorkerPool:
+    """Ограниченный пул фоновых потоков с сохранением порядка задач внутри одного ключа.
+
+    Задачи с одинаковым ключом (например, chat_id) всегда попадают в один и тот же
+    поток и выполняются строго по очереди, поэтому переходы dialog_step одного
+    клиента не перемешиваются. Разные ключи обрабатываются параллельно.
+    """
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self._queues = []
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        # Отложенные задачи: куча (срок, номер, ключ, задача) и поток, который их отпускает
+        self._delayed = []
+        self._delayed_seq = itertools.count()
+        self._delayed_cond = threading.Condition(self._lock)
+        self._stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "delayed": 0}
+
+    def _ensure_started(self):
+        # Потоки не переживают fork, поэтому запускаем их лениво в каждом воркере
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+            self._threads = []
+            for index, q in enumerate(self._queues):
+                thread = threading.Thread(target=self._run, args=(q,), name=f"{self.name}-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._delayed = []
+            threading.Thread(target=self._release_delayed, name=f"{self.name}-timer", daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, key, fn, *args, block=False, timeout=None, **kwargs):
+        """Ставит задачу в очередь ключа. Возвращает False, если очередь переполнена.
+
+        С block=True ждет освободившегося места (не дольше timeout секунд) —
+        это нужно массовым рассылкам, которые не должны терять сообщения.
+        """
+        self._ensure_started()
+        q = self._queues[zlib.crc32(str(key).encode()) % self.workers]
+        try:
+            q.put((fn, args, kwargs), block=block, timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._stats["rejected"] += 1
+            return False
+        with self._lock:
+            self._stats["submitted"] += 1
+        return True
+
+    def submit_after(self, delay, key, fn, *args, **kwargs):
+        """Ставит задачу в очередь ключа через delay секунд, не занимая поток ожиданием.
+
+        Когда срок наступает, задача ждет места в очереди (block=True): отложенную
+        задачу уже приняли, и терять ее нельзя.
+        """
+        self._ensure_started()
+        with self._delayed_cond:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._delayed_seq), key, fn, args, kwargs))
+            self._stats["delayed"] += 1
+            self._delayed_cond.notify()
+
+    def _release_delayed(self):
+        while True:
+            with self._delayed_cond:
+                while not self._delayed or self._delayed[0][0] > time.monotonic():
+                    self._delayed_cond.wait(self._delayed[0][0] - time.monotonic() if self._delayed else None)
+                _, _, key, fn, args, kwargs = heapq.heappop(self._delayed)
+            self.submit(key, fn, *args, block=True, **kwargs)
+
+    def _run(self, q):
+        while True:
+            task = q.get()
+            if task is None:
+                q.task_done()
+                return
+            fn, args, kwargs = task
+            try:
+                fn(*args, **kwargs)
+                outcome = "completed"
+            except Exception as e:
+                print(f"Ошибка в фоновой задаче {self.name}: {e}")
+                TASK_ERRORS.inc(pool=self.name)
+                outcome = "failed"
+            finally:
+                q.task_done()
+            with self._lock:
+                self._stats[outcome] += 1
+
+    def shutdown(self, timeout=10):
+        """Дожидается выполнения уже принятых задач и останавливает потоки."""
+        if self._pid != os.getpid():
+            return
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._pid = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queued"] = sum(q.qsize() for q in self._queues) if self._pid == os.getpid() else 0
+        stats["waiting"] = len(self._delayed) if self._pid == os.getpid() else 0
+        return stats
+
+
+def create_pool(name, workers, queue_size):
+    """Создает пул и регистрирует его мягкую остановку при завершении процесса."""
+    pool = KeyedWorkerPool(name, workers, queue_size)
+    atexit.register(pool.shutdown)
+    return pool
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import queue
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from db import DATABASE_URL
+
+
+class Subscriber:
+    """Очередь событий одного подключенного дашборда с ограниченным буфером."""
+
+    def __init__(self, buffer_size):
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+    def push(self, event):
+        # Медленный клиент не должен копить память: выбрасываем самые старые
+        # события и просим его перечитать состояние целиком (resync).
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                    event = {"type": "resync", "reason": "overflow"}
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventHub:
+    """Слушает NOTIFY из Postgres в одном фоновом потоке и раздает события подписчикам.
+
+    На процесс открывается одно отдельное соединение (не из пула), сколько бы
+    дашбордов ни было подключено.
+    """
+
+    def __init__(self, channel, buffer_size=100, max_subscribers=50):
+        self.channel = channel
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {"notifications": 0, "reconnects": 0}
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._subscribers = set()
+            threading.Thread(target=self._listen, name=f"listen-{self.channel}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def subscribe(self):
+        """Возвращает нового подписчика или None, если достигнут лимит подключений."""
+        self._ensure_started()
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscriber = Subscriber(self.buffer_size)
+            self._subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.push(event)
+
+    def _listen(self):
+        delay = 1
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel};")
+                delay = 1
+                if connected_before:
+                    # События могли потеряться, пока соединения не было
+                    self.publish({"type": "resync", "reason": "reconnect"})
+                connected_before = True
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._stats["notifications"] += 1
+                        try:
+                            self.publish(json.loads(notify.payload))
+                        except ValueError:
+                            print(f"Некорректное событие {self.channel}: {notify.payload[:200]}")
+            except psycopg2.Error as e:
+                if conn is not None:
+                    conn.close()
+                self._stats["reconnects"] += 1
+                print(f"Потеряно соединение LISTEN {self.channel}: {e}; переподключение через {delay} с")
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["subscribers"] = len(self._subscribers)
+        return stats
+
+
+def sse_stream(hub, subscriber, heartbeat):
+    """Генератор Server-Sent Events: события подписчика и комментарии-пинги раз в heartbeat секунд."""
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            event = subscriber.get(timeout=heartbeat)
+            if event is None:
+                yield ": ping\n\n"
+                continue
+            yield f"event: {event.get('type', 'message')}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+    finally:
+        hub.unsubscribe(subscriber)
@@ -0,0 +1,83 @@
+import io
+import csv
+import json
+import uuid
+import datetime
+import threading
+
+from db import db_connection
+from metrics import REGISTRY
+
+EXPORT_ROWS = REGISTRY.counter("export_rows_total", "Строки, отданные в выгрузках", ["export"])
+
+# Строки пишутся в ответ пачками, чтобы не отправлять по одному мелкому куску на строку
+FLUSH_ROWS = 500
+
+
+def json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"Не сериализуется в JSON: {type(value).__name__}")
+
+
+def stream_query(query, params, itersize=2000):
+    """Построчно отдает результат запроса через серверный (именованный) курсор.
+
+    В памяти процесса одновременно не больше itersize строк, сколько бы их ни
+    было в выборке. Соединение из пула занято, пока генератор не дочитан или
+    не закрыт (например, при обрыве загрузки клиентом).
+    """
+    with db_connection() as conn:
+        conn.set_session(readonly=True)
+        try:
+            with conn.cursor(name=f"export_{uuid.uuid4().hex}") as cur:
+                cur.itersize = itersize
+                cur.execute(query, params)
+                yield from cur
+        finally:
+            conn.rollback()
+            conn.set_session(readonly=False)
+
+
+def format_rows(rows, columns, fmt, name=""):
+    """Превращает поток строк в поток кусков CSV (с BOM для Excel) или JSON Lines."""
+    buffer = io.StringIO()
+    if fmt == "csv":
+        writer = csv.writer(buffer)
+        buffer.write("﻿")
+        writer.writerow(columns)
+        write = lambda row: writer.writerow(
+            value.isoformat() if isinstance(value, datetime.datetime) else value for value in row)
+    else:
+        write = lambda row: buffer.write(
+            json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=json_default) + "\n")
+
+    pending = 0
+    for row in rows:
+        write(row)
+        pending += 1
+        if pending >= FLUSH_ROWS:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            EXPORT_ROWS.inc(pending, export=name)
+            pending = 0
+    EXPORT_ROWS.inc(pending, export=name)
+    yield buffer.getvalue()
+
+
+class ExportSlots:
+    """Ограничение числа одновременных выгрузок в процессе.
+
+    Каждая выгрузка держит соединение из пула все время загрузки; без
+    ограничения несколько больших выгрузок заняли бы пул целиком.
+    """
+
+    def __init__(self, limit):
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    def acquire(self):
+        return self._semaphore.acquire(blocking=False)
+
+    def release(self):
+        self._semaphore.release()
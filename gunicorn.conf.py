@@ -0,0 +1,60 @@
+"""Настройки gunicorn для обоих ботов.
+
+    gunicorn -c gunicorn.conf.py telegram_bot:app
+    gunicorn -c gunicorn.conf.py app:app
+
+Приложение импортируется один раз в мастере (preload_app): переменные
+окружения, Flask и модули бота загружаются до fork, и воркер стартует с уже
+готовой копией памяти. Схему БД мастер тоже проверяет один раз, до запуска
+воркеров; миграции и advisory-блокировка нужны, только если схема отстает.
+Время старта мастера и воркеров пишется в лог и в /metrics (startup_*).
+"""
+import os
+import sys
+import time
+
+# Файл настроек gunicorn читает раньше, чем импортирует приложение
+_config_loaded = time.monotonic()
+STARTUP = {}
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+# Потоки нужны SSE (/api/events) и потоковым выгрузкам: каждое такое подключение держит поток.
+# Бот читает то же GUNICORN_THREADS и оставляет WEBHOOK_RESERVED_THREADS потоков вебхуку.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+preload_app = True
+
+
+def when_ready(server):
+    """Мастер: проверка схемы до fork и отчет о времени старта."""
+    app_module = (getattr(server.app, "app_uri", None) or server.cfg.wsgi_app or "").split(":")[0]
+    module = sys.modules.get(app_module)
+    STARTUP["import_seconds"] = round(time.monotonic() - _config_loaded, 4)
+    if module is None or not hasattr(module, "init_db"):
+        server.log.warning("Приложение не загружено в мастере, схему проверят воркеры при первом запросе")
+        return
+
+    started = time.monotonic()
+    if module.init_db() is None:
+        server.log.warning("Схема не проверена в мастере, воркеры повторят проверку при первом запросе")
+    # Соединения мастера воркерам не нужны, а их сокеты после fork были бы общими
+    from db import close_pool
+    close_pool()
+    STARTUP["schema_check_seconds"] = round(time.monotonic() - started, 4)
+    STARTUP["master_seconds"] = round(time.monotonic() - _config_loaded, 4)
+
+    from metrics import REGISTRY
+    REGISTRY.register_stats("startup", lambda: dict(STARTUP))
+    server.log.info("Мастер готов за %.0f мс: импорт %.0f мс, проверка схемы %.0f мс",
+                    STARTUP["master_seconds"] * 1000, STARTUP["import_seconds"] * 1000,
+                    STARTUP["schema_check_seconds"] * 1000)
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+
+def post_worker_init(worker):
+    STARTUP["worker_seconds"] = round(time.monotonic() - worker.forked_at, 4)
+    worker.log.info("Воркер %s готов за %.1f мс после fork", worker.pid, STARTUP["worker_seconds"] * 1000)
@@ -1,6 +1,12 @@
 # init_db.py
-from telegram_bot import init_db
+# Использование: python init_db.py [telegram|whatsapp]
+import sys
 
-print("Starting Telegram bot database initialization...")
-init_db()
-print("Database initialization complete.")
+from migrations import migrate, TELEGRAM_MIGRATIONS, WHATSAPP_MIGRATIONS
+
+MIGRATIONS = {"telegram": TELEGRAM_MIGRATIONS, "whatsapp": WHATSAPP_MIGRATIONS}
+
+component = sys.argv[1] if len(sys.argv) > 1 else "telegram"
+print(f"Starting {component} bot database migrations...")
+applied = migrate(component, MIGRATIONS[component])
+print(f"Database initialization complete. Applied migrations: {applied or 'none'}")
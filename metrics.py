@@ -0,0 +1,178 @@
+import os
+import time
+import bisect
+import threading
+from functools import wraps
+
+# --- МЕТРИКИ В ФОРМАТЕ PROMETHEUS ---
+# Легкая собственная реализация без внешних зависимостей: счетчики и
+# гистограммы с метками, обновление — один захват блокировки. Значения свои
+# у каждого процесса (воркера gunicorn), и /metrics отдает метрики того воркера,
+# который принял запрос, поэтому у каждой серии есть метка pid. Без нее
+# счетчики разных воркеров выглядели бы как одна серия, которая то растет, то
+# падает; суммировать по воркерам нужно в запросе: sum without (pid) (rate(...)).
+
+# Границы по умолчанию рассчитаны на времена от долей миллисекунды до секунд
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [(name, value) for name, value in zip(names, values)] + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """Монотонный счетчик с метками."""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self, extra=()):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key, extra)} {value}"
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами, суммой и количеством наблюдений."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Корзины хранятся без накопления, складываются при выводе
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self, extra=()):
+        extra = list(extra)
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, extra + [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key, extra)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key, extra)} {count}"
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+def timed(histogram, **labels):
+    """Декоратор: время выполнения функции попадает в гистограмму."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._stats_sources = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        # Повторная регистрация (модуль импортирован дважды) возвращает ту же метрику
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def register_stats(self, prefix, source, **labels):
+        """Экспортирует словарь stats() (пул, кэш, очереди) как gauge-метрики prefix_<ключ>."""
+        with self._lock:
+            self._stats_sources.append((prefix, source, labels))
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus 0.0.4 (все серии с меткой pid процесса)."""
+        lines = []
+        process = [("pid", os.getpid())]
+        with self._lock:
+            metrics = list(self._metrics.values())
+            sources = list(self._stats_sources)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples(process))
+
+        gauges = {}
+        for prefix, source, labels in sources:
+            try:
+                stats = source()
+            except Exception as e:
+                print(f"Ошибка сбора метрик {prefix}: {e}")
+                continue
+            for key, value in _flatten(stats):
+                gauges.setdefault(f"{prefix}_{key}", []).append((labels, value))
+        for name, samples in sorted(gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels.keys(), labels.values(), process)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _flatten(stats, prefix=""):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}_")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+REGISTRY = Registry()
@@ -0,0 +1,384 @@
+import time
+import threading
+
+from db import db_cursor
+
+# --- МИГРАЦИИ СХЕМЫ ---
+# Каждая миграция — (версия, описание, SQL). Уже примененные версии записываются
+# в schema_migrations отдельно для каждого бота, новые миграции добавляются
+# только в конец списка. Первые версии используют IF NOT EXISTS, чтобы
+# подхватить базы, созданные старым init_db().
+
+# Журнал обработанных апдейтов общий для обоих ботов (source различает каналы);
+# миграция входит в оба списка и идемпотентна.
+PROCESSED_UPDATES_SQL = '''
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        source VARCHAR(20) NOT NULL,
+        update_key VARCHAR(100) NOT NULL,
+        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (source, update_key)
+    );
+    CREATE INDEX IF NOT EXISTS processed_updates_received_idx ON processed_updates (source, received_at);
+'''
+
+# Помесячные секции таблиц сообщений. Функция создает секцию месяца; если
+# строки этого месяца уже попали в секцию по умолчанию (секция не была создана
+# заранее), они переносятся в новую. Каталог message_archive помнит, какие
+# месяцы клиента ушли в архив на диск (см. archive.py).
+MESSAGE_PARTITIONING_SQL = '''
+    CREATE OR REPLACE FUNCTION create_monthly_partition(parent TEXT, month_start DATE) RETURNS TEXT AS $$
+    DECLARE
+        range_start DATE := date_trunc('month', month_start);
+        range_end DATE := date_trunc('month', month_start) + INTERVAL '1 month';
+        partition_name TEXT := parent || '_p' || to_char(month_start, 'YYYYMM');
+    BEGIN
+        IF to_regclass(partition_name) IS NOT NULL THEN
+            RETURN partition_name;
+        END IF;
+        EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS)', partition_name, parent);
+        IF to_regclass(parent || '_default') IS NOT NULL THEN
+            EXECUTE format('WITH moved AS (DELETE FROM %I WHERE timestamp >= %L AND timestamp < %L RETURNING *) '
+                           'INSERT INTO %I SELECT * FROM moved', parent || '_default', range_start, range_end, partition_name);
+        END IF;
+        EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                       parent, partition_name, range_start, range_end);
+        RETURN partition_name;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TABLE IF NOT EXISTS message_archive (
+        parent VARCHAR(50) NOT NULL,
+        month DATE NOT NULL,
+        client_id INTEGER NOT NULL,
+        first_id INTEGER NOT NULL,
+        last_id INTEGER NOT NULL,
+        messages INTEGER NOT NULL,
+        PRIMARY KEY (parent, client_id, month)
+    );
+'''
+
+# Смещение и длина gzip-потока клиента в файле архива: чтение истории одного
+# клиента не распаковывает весь месяц. У старых файлов столбцы пустые.
+ARCHIVE_OFFSETS_SQL = '''
+    ALTER TABLE message_archive ADD COLUMN IF NOT EXISTS file_offset BIGINT,
+        ADD COLUMN IF NOT EXISTS file_length BIGINT;
+'''
+
+
+def partition_by_month_sql(table, columns, column_names, indexes):
+    """SQL перевода таблицы сообщений на секции по месяцам timestamp.
+
+    Таблица пересоздается как секционированная с тем же sequence для id, данные
+    копируются в секции своих месяцев. Первичный ключ секционированной таблицы
+    обязан включать ключ секционирования, поэтому он становится (id, timestamp).
+    """
+    return f'''
+        ALTER TABLE {table} RENAME TO {table}_unpartitioned;
+        ALTER TABLE {table}_unpartitioned RENAME CONSTRAINT {table}_pkey TO {table}_unpartitioned_pkey;
+        CREATE TABLE {table} (
+            id INTEGER NOT NULL DEFAULT nextval('{table}_id_seq'),
+            {columns},
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+        ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id;
+        -- Секции для всех месяцев, где уже есть сообщения, плюс текущий и следующий
+        SELECT create_monthly_partition('{table}', month::date) FROM generate_series(
+            date_trunc('month', LEAST((SELECT min(timestamp) FROM {table}_unpartitioned), CURRENT_TIMESTAMP)),
+            date_trunc('month', CURRENT_TIMESTAMP) + INTERVAL '1 month', INTERVAL '1 month') AS month;
+        CREATE TABLE {table}_default PARTITION OF {table} DEFAULT;
+        INSERT INTO {table} (id, {column_names}, timestamp)
+            SELECT id, {column_names}, COALESCE(timestamp, CURRENT_TIMESTAMP) FROM {table}_unpartitioned;
+        DROP TABLE {table}_unpartitioned;
+        {indexes}
+    '''
+
+TELEGRAM_MIGRATIONS = [
+    (1, "Таблицы tg_clients и tg_messages", '''
+        CREATE TABLE IF NOT EXISTS tg_clients (
+            id SERIAL PRIMARY KEY,
+            chat_id VARCHAR(50) UNIQUE NOT NULL,
+            name VARCHAR(100),
+            status VARCHAR(50) DEFAULT 'new',
+            managed_by_manager BOOLEAN DEFAULT FALSE,
+            dialog_step VARCHAR(50) DEFAULT 'start',
+            budget VARCHAR(100),
+            car_type VARCHAR(100)
+        );
+        CREATE TABLE IF NOT EXISTS tg_messages (
+            id SERIAL PRIMARY KEY,
+            client_id INTEGER REFERENCES tg_clients(id),
+            message_text TEXT,
+            is_voice BOOLEAN DEFAULT FALSE,
+            sender_is_bot BOOLEAN,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    '''),
+    (2, "Индексы для истории чата и поиска активного клиента", '''
+        CREATE INDEX IF NOT EXISTS tg_messages_client_timestamp_idx ON tg_messages (client_id, timestamp);
+        CREATE INDEX IF NOT EXISTS tg_clients_managed_idx ON tg_clients (chat_id) WHERE managed_by_manager;
+    '''),
+    (3, "Счетчик изменений списка клиентов для ETag", '''
+        CREATE TABLE IF NOT EXISTS change_counters (
+            name VARCHAR(50) PRIMARY KEY,
+            value BIGINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO change_counters (name) VALUES ('tg_clients') ON CONFLICT DO NOTHING;
+        -- Счетчик растет только когда меняется то, что видно в списке (новый клиент,
+        -- имя, статус). Шаги диалога его не трогают, чтобы не блокировать строку счетчика.
+        CREATE OR REPLACE FUNCTION bump_tg_clients_counter() RETURNS trigger AS $$
+        BEGIN
+            UPDATE change_counters SET value = value + 1 WHERE name = 'tg_clients';
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER tg_clients_counter_insert AFTER INSERT OR DELETE ON tg_clients
+            FOR EACH ROW EXECUTE FUNCTION bump_tg_clients_counter();
+        CREATE TRIGGER tg_clients_counter_update AFTER UPDATE OF name, status ON tg_clients
+            FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.status IS DISTINCT FROM NEW.status)
+            EXECUTE FUNCTION bump_tg_clients_counter();
+    '''),
+    (4, "Индекс для постраничной истории по (client_id, id)", '''
+        CREATE INDEX IF NOT EXISTS tg_messages_client_id_idx ON tg_messages (client_id, id);
+    '''),
+    (5, "NOTIFY tg_events о новых клиентах и сообщениях для живого дашборда", '''
+        CREATE OR REPLACE FUNCTION notify_tg_client() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('tg_events', json_build_object(
+                'type', 'client', 'id', NEW.id, 'chat_id', NEW.chat_id, 'name', NEW.name,
+                'status', NEW.status, 'managed_by_manager', NEW.managed_by_manager
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER tg_clients_notify_insert AFTER INSERT ON tg_clients
+            FOR EACH ROW EXECUTE FUNCTION notify_tg_client();
+        CREATE TRIGGER tg_clients_notify_update AFTER UPDATE OF name, status, managed_by_manager ON tg_clients
+            FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.status IS DISTINCT FROM NEW.status
+                               OR OLD.managed_by_manager IS DISTINCT FROM NEW.managed_by_manager)
+            EXECUTE FUNCTION notify_tg_client();
+
+        -- Полезная нагрузка NOTIFY ограничена 8000 байт, поэтому длинный текст
+        -- обрезается; дашборд при truncated=true дочитывает его через /api/history.
+        CREATE OR REPLACE FUNCTION notify_tg_message() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('tg_events', json_build_object(
+                'type', 'message', 'id', NEW.id, 'client_id', NEW.client_id,
+                'chat_id', (SELECT chat_id FROM tg_clients WHERE id = NEW.client_id),
+                'message_text', left(NEW.message_text, 1500),
+                'truncated', length(NEW.message_text) > 1500,
+                'sender_is_bot', NEW.sender_is_bot, 'is_voice', NEW.is_voice, 'timestamp', NEW.timestamp
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER tg_messages_notify AFTER INSERT ON tg_messages
+            FOR EACH ROW EXECUTE FUNCTION notify_tg_message();
+    '''),
+    (6, "Журнал обработанных апдейтов для отсева повторов", PROCESSED_UPDATES_SQL),
+    (7, "Назначения клиентов менеджерам и общие сессии менеджеров", '''
+        -- У клиента не больше одного менеджера, у менеджера — сколько угодно чатов.
+        -- managed_by_manager в tg_clients остается: на нем держится проверка в save_turn.
+        CREATE TABLE IF NOT EXISTS manager_assignments (
+            client_id INTEGER PRIMARY KEY REFERENCES tg_clients(id) ON DELETE CASCADE,
+            manager_chat_id VARCHAR(50) NOT NULL,
+            assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS manager_assignments_manager_idx ON manager_assignments (manager_chat_id, assigned_at);
+        -- Вход менеджера и его текущий чат видны всем воркерам
+        CREATE TABLE IF NOT EXISTS manager_sessions (
+            manager_chat_id VARCHAR(50) PRIMARY KEY,
+            logged_in_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            active_chat_id VARCHAR(50)
+        );
+    '''),
+    (8, "Помесячные секции tg_messages и каталог архива", MESSAGE_PARTITIONING_SQL + partition_by_month_sql(
+        "tg_messages",
+        "client_id INTEGER REFERENCES tg_clients(id), message_text TEXT, is_voice BOOLEAN DEFAULT FALSE, sender_is_bot BOOLEAN",
+        "client_id, message_text, is_voice, sender_is_bot",
+        '''CREATE INDEX tg_messages_client_timestamp_idx ON tg_messages (client_id, timestamp);
+        CREATE INDEX tg_messages_client_id_idx ON tg_messages (client_id, id);
+        CREATE TRIGGER tg_messages_notify AFTER INSERT ON tg_messages
+            FOR EACH ROW EXECUTE FUNCTION notify_tg_message();''')),
+    (9, "Рассылки и статусы доставки по получателям", '''
+        -- Счетчики sent/failed обновляются каждой пачкой, чтобы прогресс не считался по получателям
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id SERIAL PRIMARY KEY,
+            message_text TEXT NOT NULL,
+            filters JSONB NOT NULL DEFAULT '{}',
+            status VARCHAR(20) NOT NULL DEFAULT 'running'
+                CHECK (status IN ('running', 'paused', 'cancelled', 'completed')),
+            created_by VARCHAR(50),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS campaign_recipients (
+            campaign_id INTEGER NOT NULL REFERENCES campaigns(id) ON DELETE CASCADE,
+            client_id INTEGER NOT NULL REFERENCES tg_clients(id) ON DELETE CASCADE,
+            chat_id VARCHAR(50) NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'failed')),
+            message_id BIGINT,
+            sent_at TIMESTAMP,
+            PRIMARY KEY (campaign_id, client_id)
+        );
+        -- Очередную пачку отправитель берет из еще не отправленных получателей
+        CREATE INDEX IF NOT EXISTS campaign_recipients_pending_idx ON campaign_recipients (campaign_id, client_id)
+            WHERE status = 'pending';
+    '''),
+    (10, "Полнотекстовые индексы для поиска клиентов и сообщений", '''
+        -- Выражения совпадают с search.py. Индекс на секционированной tg_messages
+        -- создается во всех секциях, а новые секции получают его при ATTACH.
+        CREATE INDEX IF NOT EXISTS tg_clients_search_idx ON tg_clients
+            USING GIN (to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(car_type, '')));
+        CREATE INDEX IF NOT EXISTS tg_messages_search_idx ON tg_messages
+            USING GIN (to_tsvector('russian', coalesce(message_text, '')));
+        -- Триграммы ускоряют фильтр q (ILIKE по подстроке) в /api/clients и выгрузке.
+        -- pg_trgm есть не в каждой сборке Postgres, а создать расширение может не
+        -- каждая роль (управляемые БД); без него фильтр работает как раньше.
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+                BEGIN
+                    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                    CREATE INDEX IF NOT EXISTS tg_clients_name_trgm_idx ON tg_clients USING GIN (name gin_trgm_ops);
+                EXCEPTION WHEN insufficient_privilege THEN
+                    RAISE NOTICE 'Нет прав на CREATE EXTENSION pg_trgm, триграммный индекс tg_clients.name не создан';
+                END;
+            ELSE
+                RAISE NOTICE 'pg_trgm недоступен, триграммный индекс tg_clients.name не создан';
+            END IF;
+        END
+        $$;
+    '''),
+    (11, "Удаление неиспользуемого индекса managed_by_manager", '''
+        -- Закрепленных клиентов ищут по manager_assignments, частичный индекс никто не читает
+        DROP INDEX IF EXISTS tg_clients_managed_idx;
+    '''),
+    (12, "Смещения клиентов в файлах архива", ARCHIVE_OFFSETS_SQL),
+]
+
+WHATSAPP_MIGRATIONS = [
+    (1, "Таблицы clients и messages", '''
+        CREATE TABLE IF NOT EXISTS clients (
+            id SERIAL PRIMARY KEY,
+            phone_number VARCHAR(50) UNIQUE NOT NULL,
+            name VARCHAR(100),
+            status VARCHAR(50) DEFAULT 'new',
+            managed_by_manager BOOLEAN DEFAULT FALSE,
+            dialog_step VARCHAR(50) DEFAULT 'start',
+            budget VARCHAR(100),
+            car_type VARCHAR(100)
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            client_id INTEGER REFERENCES clients(id),
+            message_text TEXT,
+            sender_is_bot BOOLEAN,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    '''),
+    (2, "Индекс для истории чата", '''
+        CREATE INDEX IF NOT EXISTS messages_client_timestamp_idx ON messages (client_id, timestamp);
+    '''),
+    (3, "Журнал обработанных сообщений для отсева повторов", PROCESSED_UPDATES_SQL),
+    (4, "Статусы доставки исходящих сообщений", '''
+        CREATE TABLE IF NOT EXISTS message_statuses (
+            message_id VARCHAR(200) NOT NULL,
+            recipient VARCHAR(50),
+            status VARCHAR(20) NOT NULL,
+            status_timestamp TIMESTAMP,
+            errors JSONB,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (message_id, status)
+        );
+    '''),
+    (5, "Помесячные секции messages и каталог архива", MESSAGE_PARTITIONING_SQL + partition_by_month_sql(
+        "messages",
+        "client_id INTEGER REFERENCES clients(id), message_text TEXT, sender_is_bot BOOLEAN",
+        "client_id, message_text, sender_is_bot",
+        "CREATE INDEX messages_client_timestamp_idx ON messages (client_id, timestamp);")),
+    (6, "Смещения клиентов в файлах архива", ARCHIVE_OFFSETS_SQL),
+]
+
+
+def pending_versions(cur, component, migrations):
+    """Версии, которые еще не применены; обычный SELECT без блокировок и DDL."""
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        return [version for version, _, _ in migrations]
+    cur.execute("SELECT version FROM schema_migrations WHERE component = %s;", (component,))
+    applied = {row[0] for row in cur.fetchall()}
+    return [version for version, _, _ in migrations if version not in applied]
+
+
+def migrate(component, migrations):
+    """Применяет недостающие миграции в одной транзакции. Возвращает список новых версий."""
+    # Схема почти всегда актуальна: проверяем без блокировки и не ждем других процессов
+    with db_cursor() as cur:
+        if not pending_versions(cur, component, migrations):
+            return []
+    with db_cursor() as cur:
+        # Несколько воркеров могут стартовать одновременно: миграции выполняет
+        # только тот, кто взял блокировку, остальные ждут и видят готовую схему.
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'));")
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                component VARCHAR(50) NOT NULL,
+                version INTEGER NOT NULL,
+                name TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (component, version)
+            );
+        ''')
+        cur.execute("SELECT version FROM schema_migrations WHERE component = %s;", (component,))
+        applied = {row[0] for row in cur.fetchall()}
+        new_versions = []
+        for version, name, sql in migrations:
+            if version in applied:
+                continue
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (component, version, name) VALUES (%s, %s, %s);",
+                        (component, version, name))
+            new_versions.append(version)
+    return new_versions
+
+
+_checked = set()
+_checked_lock = threading.Lock()
+
+
+def ensure_schema(component, migrations):
+    """migrate() не чаще одного раза на процесс.
+
+    Мастер gunicorn с preload_app проверяет схему до fork (gunicorn.conf.py),
+    и воркеры наследуют отметку, не обращаясь к БД. Без preload каждый
+    процесс проверяет схему при первом запросе — одним SELECT.
+    """
+    if component in _checked:
+        return []
+    with _checked_lock:
+        if component in _checked:
+            return []
+        applied = migrate(component, migrations)
+        _checked.add(component)
+        return applied
+
+
+def init_schema(component, migrations):
+    """ensure_schema() для init_db() ботов: ошибка пишется в лог, а не пробрасывается.
+
+    Возвращает список примененных версий или None при ошибке. Схема тогда не
+    отмечается проверенной, и before_request повторит проверку на первом запросе.
+    """
+    started = time.perf_counter()
+    try:
+        applied = ensure_schema(component, migrations)
+    except Exception as e:
+        print(f"Ошибка при инициализации базы данных: {e}")
+        return None
+    print(f"База данных успешно инициализирована за {(time.perf_counter() - started) * 1000:.0f} мс. "
+          f"Новые миграции: {applied or 'нет'}")
+    return applied
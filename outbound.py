@@ -0,0 +1,349 @@
+import os
+import time
+import random
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# requests импортируется при загрузке модуля: с preload_app это происходит один
+# раз в мастере gunicorn, и воркеры получают модуль готовым после fork
+import requests
+from requests.adapters import HTTPAdapter
+
+from dispatcher import create_pool, TASK_ERRORS
+from metrics import REGISTRY
+
+OUTBOUND_SECONDS = REGISTRY.histogram(
+    "outbound_request_duration_seconds", "Время запроса к API мессенджера", ["api", "method"])
+OUTBOUND_RETRIES = REGISTRY.counter(
+    "outbound_retries_total", "Повторы запросов к API мессенджера", ["api", "method"])
+OUTBOUND_ERRORS = REGISTRY.counter(
+    "outbound_errors_total", "Запросы к API мессенджера, завершившиеся ошибкой", ["api", "method"])
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше burst про запас."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Блокирует поток, пока не появится токен (или не закончится пауза после 429)."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Берет токен без ожидания. Возвращает 0 или сколько секунд ждать следующего."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if now >= self._paused_until and self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return max(self._paused_until - now, (1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Запрещает выдачу токенов на seconds секунд (retry_after от API)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class OutboundClient:
+    """Общая подсистема исходящих запросов к API мессенджера.
+
+    Держит keep-alive сессию с пулом соединений, ограничивает частоту отправки
+    глобально и по каждому получателю, повторяет запросы при 429/5xx с
+    экспоненциальной задержкой. post_async() не блокирует обработчик: запрос
+    уходит в фоновый пул, где сообщения одному получателю идут по порядку.
+    Долгие операции (скачивание и загрузка файлов) выполняются в отдельном
+    пуле из io_workers потоков и не занимают потоки очередей получателей.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, name, global_rate, per_key_rate=None, per_key_burst=None,
+                 workers=8, queue_size=10000, max_retries=4, timeout=10, io_workers=4):
+        self.name = name
+        self.per_key_rate = per_key_rate
+        self.per_key_burst = per_key_burst
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.workers = workers
+        self.io_workers = io_workers
+        self._global = TokenBucket(global_rate)
+        self._per_key = OrderedDict()
+        self._per_key_limit = 10000
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._session = None
+        self._session_pid = None
+        self._pool = create_pool(f"{name}-outbound", workers, queue_size)
+        self._io_executor = None
+        self._io_pid = None
+        self._stats = {"sent": 0, "failed": 0, "retries": 0, "rate_limited": 0, "io_in_flight": 0}
+
+    @property
+    def session(self):
+        """Keep-alive сессия текущего процесса (после fork создается заново)."""
+        if self._session is None or self._session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.workers * 2)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+            self._session_pid = os.getpid()
+        return self._session
+
+    def _io(self):
+        """Пул долгих операций текущего процесса (потоки не переживают fork)."""
+        if self._io_pid != os.getpid():
+            with self._lock:
+                if self._io_pid != os.getpid():
+                    self._io_executor = ThreadPoolExecutor(self.io_workers, thread_name_prefix=f"{self.name}-io")
+                    self._io_pid = os.getpid()
+        return self._io_executor
+
+    def _key_bucket(self, key):
+        if not self.per_key_rate or key is None:
+            return None
+        with self._lock:
+            bucket = self._per_key.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.per_key_rate, self.per_key_burst)
+                self._per_key[key] = bucket
+                if len(self._per_key) > self._per_key_limit:
+                    self._per_key.popitem(last=False)
+            else:
+                self._per_key.move_to_end(key)
+            return bucket
+
+    def post(self, key, url, body_factory=None, process_rate=True, **kwargs):
+        """Синхронно отправляет POST с учетом лимитов и повторов. Возвращает Response или None.
+
+        Ждет лимитов и пауз между повторами в вызывающем потоке, поэтому нужен
+        потокам, у которых нет соседей по очереди (рассылка). body_factory —
+        функция, возвращающая свежее тело запроса (data) для каждой попытки;
+        нужна потоковым телам, которые нельзя прочитать дважды. process_rate=False —
+        не брать токен из доли процесса в общем лимите: у вызывающего свое ведро
+        (рассылка идет только в одном процессе и сама держит свой темп).
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        method = url.rsplit("/", 1)[-1]
+        bucket = self._key_bucket(key)
+        for attempt in range(self.max_retries + 1):
+            if bucket is not None:
+                bucket.acquire()
+            if process_rate:
+                self._global.acquire()
+            response, retry, error = self._attempt(url, method, kwargs, body_factory)
+            if not retry:
+                return response
+            if attempt == self.max_retries:
+                break
+            time.sleep(self._retry_delay(attempt, retry, bucket, method))
+        self._give_up(method, error)
+        return None
+
+    def _attempt(self, url, method, kwargs, body_factory=None):
+        """Одна попытка POST. Возвращает (response или None, повторять ли, ошибка).
+
+        «Повторять» — это True или retry_after из ответа 429 в секундах. Ошибки
+        сети при создании тела (скачивание файла) повторяются так же, как ошибки
+        самого запроса.
+        """
+        try:
+            if body_factory is not None:
+                kwargs = dict(kwargs, data=body_factory())
+            started = time.perf_counter()
+            try:
+                response = self.session.post(url, **kwargs)
+            finally:
+                OUTBOUND_SECONDS.observe(time.perf_counter() - started, api=self.name, method=method)
+            if response.status_code not in self.RETRY_STATUSES:
+                response.raise_for_status()
+                self._count("sent")
+                return response, False, None
+            retry = True
+            if response.status_code == 429:
+                self._count("rate_limited")
+                retry = self._retry_after(response) or True
+            return None, retry, f"HTTP {response.status_code}: {response.text[:200]}"
+        except requests.exceptions.HTTPError as e:
+            # 4xx кроме 429 повторять бессмысленно
+            self._count("failed")
+            OUTBOUND_ERRORS.inc(api=self.name, method=method)
+            print(f"Ошибка {self.name} при запросе {method}: {e}; ответ: {e.response.text[:200]}")
+            return None, False, None
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, OSError) as e:
+            return None, True, str(e)
+
+    def _retry_delay(self, attempt, retry, bucket, method):
+        """Пауза перед повтором: retry_after от API или экспоненциальная задержка с разбросом."""
+        self._count("retries")
+        OUTBOUND_RETRIES.inc(api=self.name, method=method)
+        if retry is True:
+            return min(30.0, 0.5 * 2 ** attempt) * (1 + random.random() / 2)
+        if bucket is not None:
+            bucket.pause(retry)
+        return retry
+
+    def _give_up(self, method, error):
+        self._count("failed")
+        OUTBOUND_ERRORS.inc(api=self.name, method=method)
+        print(f"Не удалось выполнить запрос {self.name} после {self.max_retries + 1} попыток: {error}")
+
+    # --- ФОНОВАЯ ОТПРАВКА ---
+    # Поток пула обслуживает много получателей, поэтому ждать лимита чата или
+    # паузы перед повтором в нем нельзя: один частый чат (например, менеджерский)
+    # задержал бы всех, кто попал в тот же поток. Задача, которой пока нельзя
+    # отправляться, откладывается таймером пула, а следующие задачи того же
+    # получателя встают за ней в очередь _waiting, чтобы не нарушить порядок.
+    # Так же ждет попытка, которая выполняется в пуле долгих операций: когда она
+    # завершится, очередь получателя снова ставится в пул.
+
+    def post_async(self, key, url, block=False, body_factory=None, **kwargs):
+        """Ставит POST в фоновую очередь получателя. Возвращает False, если очередь переполнена.
+
+        С body_factory (потоковое тело, см. post()) каждая попытка вместе с
+        созданием тела выполняется в пуле долгих операций.
+        """
+        accepted = self._pool.submit(key, self._enqueue, key, _PendingPost(url, kwargs, body_factory), block=block)
+        if not accepted:
+            self._count("failed")
+            OUTBOUND_ERRORS.inc(api=self.name, method=url.rsplit("/", 1)[-1])
+            print(f"Очередь исходящих {self.name} переполнена, сообщение для {key} отброшено")
+        return accepted
+
+    def run_background(self, fn, *args):
+        """Выполняет долгую задачу (например, скачивание в кэш) в пуле долгих операций."""
+        return self._io().submit(self._run_background, fn, args)
+
+    def _run_background(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"Ошибка фоновой задачи {self.name}: {e}")
+            TASK_ERRORS.inc(pool=f"{self.name}-io")
+
+    def _enqueue(self, key, job):
+        with self._lock:
+            waiting = self._waiting.get(key)
+            if waiting is not None:
+                # Получатель ждет таймера — задача встает в очередь за отложенной
+                waiting.append(job)
+                return
+            self._waiting[key] = deque([job])
+        self._drain(key)
+
+    def _drain(self, key):
+        """Выполняет задачи получателя по порядку, пока очередная не упрется в лимит."""
+        while True:
+            with self._lock:
+                waiting = self._waiting[key]
+                if not waiting:
+                    del self._waiting[key]
+                    return
+                job = waiting[0]
+            try:
+                delay = job.run(self, key)
+            except Exception as e:
+                # Ошибка одной задачи не должна оставить остальные задачи получателя в очереди
+                print(f"Ошибка фоновой задачи {self.name} для {key}: {e}")
+                TASK_ERRORS.inc(pool=self._pool.name)
+                delay = None
+            if delay is _IN_FLIGHT:
+                return
+            if delay:
+                self._pool.submit_after(delay, key, self._drain, key)
+                return
+            with self._lock:
+                waiting.popleft()
+
+    def _post_step(self, key, job):
+        """Шаг фоновой отправки: None, если задача завершена, иначе через сколько секунд повторить.
+
+        _IN_FLIGHT — попытка ушла в пул долгих операций и по завершении вернет
+        очередь получателя в пул.
+        """
+        bucket = self._key_bucket(key)
+        method = job.url.rsplit("/", 1)[-1]
+        if job.future is not None:
+            future, job.future = job.future, None
+            _, retry, error = future.result()
+        else:
+            if bucket is not None:
+                wait = bucket.try_acquire()
+                if wait:
+                    return wait
+            # Общий лимит процесса одинаков для всех получателей: ожидание его никого не обгоняет
+            self._global.acquire()
+            job.kwargs.setdefault("timeout", self.timeout)
+            if job.body_factory is not None:
+                self._count("io_in_flight")
+                job.future = self._io().submit(self._attempt, job.url, method, job.kwargs, job.body_factory)
+                job.future.add_done_callback(lambda _: self._resume(key))
+                return _IN_FLIGHT
+            _, retry, error = self._attempt(job.url, method, job.kwargs)
+        if not retry:
+            return None
+        if job.attempt == self.max_retries:
+            self._give_up(method, error)
+            return None
+        delay = self._retry_delay(job.attempt, retry, bucket, method)
+        job.attempt += 1
+        return delay
+
+    def _resume(self, key):
+        with self._lock:
+            self._stats["io_in_flight"] -= 1
+        self._pool.submit(key, self._drain, key, block=True)
+
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.json()["parameters"]["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            pass
+        try:
+            return float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            return None
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["waiting_recipients"] = len(self._waiting)
+        stats["queue"] = self._pool.stats()
+        return stats
+
+
+# Попытка выполняется в пуле долгих операций, очередь получателя ждет ее
+_IN_FLIGHT = object()
+
+
+class _PendingPost:
+    """Фоновый POST: номер попытки и незавершенная попытка переживают откладывание задачи."""
+
+    def __init__(self, url, kwargs, body_factory=None):
+        self.url = url
+        self.kwargs = kwargs
+        self.body_factory = body_factory
+        self.future = None
+        self.attempt = 0
+
+    def run(self, client, key):
+        return client._post_step(key, self)
+
@@ -0,0 +1,70 @@
+import re
+
+# --- ПОИСК ПО КЛИЕНТАМ И СООБЩЕНИЯМ ---
+# Выражения должны совпадать с индексами миграции 10 (migrations.py),
+# иначе Postgres не сможет ими воспользоваться.
+CLIENT_VECTOR = "to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(car_type, ''))"
+MESSAGE_VECTOR = "to_tsvector('russian', coalesce(message_text, ''))"
+
+_WORD = re.compile(r"\w+")
+
+
+def prefix_query(text):
+    """tsquery, где каждое слово запроса — префикс: «иван внед» находит «Иван, Внедорожник».
+
+    Из запроса берутся только буквы и цифры, так что синтаксис tsquery не
+    может прийти от пользователя. None, если слов нет.
+    """
+    words = _WORD.findall(text.lower())
+    return " & ".join(f"{word}:*" for word in words[:8]) or None
+
+
+def search_clients(cur, text, limit, offset=0):
+    """Клиенты по имени, типу авто (префиксы слов) или точному chat_id, лучшие сверху.
+
+    Точное совпадение chat_id или имени поднимается над частичными.
+    Возвращает limit + 1 строк, если есть следующая страница.
+    """
+    query = prefix_query(text)
+    if query is None:
+        return []
+    cur.execute(
+        "SELECT id, chat_id, name, status, budget, car_type, "
+        f"ts_rank({CLIENT_VECTOR}, to_tsquery('simple', %s)) + (chat_id = %s)::int "
+        "+ (lower(name) = lower(%s))::int AS rank "
+        f"FROM tg_clients WHERE {CLIENT_VECTOR} @@ to_tsquery('simple', %s) OR chat_id = %s "
+        "ORDER BY rank DESC, id DESC LIMIT %s OFFSET %s;",
+        (query, text, text, query, text, limit + 1, offset)
+    )
+    columns = [column.name for column in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def search_messages(cur, text, limit, offset=0, chat_id=None, since=None, candidates=2000):
+    """Сообщения по тексту (с учетом словоформ) с фрагментом, лучшие сверху.
+
+    Запрос в синтаксисе веб-поиска: "точная фраза", -исключить, or. Поиск по
+    индексу быстрый даже для частых слов, а ранжирование пересчитывает вектор
+    каждой строки, поэтому ранжируются только candidates самых новых совпадений.
+    Фрагмент (ts_headline) строится только для строк страницы. since
+    ограничивает месяцы, которые читает Postgres; архив на диске не ищется.
+    """
+    query = "websearch_to_tsquery('russian', %s)"
+    cur.execute(
+        "WITH hits AS ("
+        "SELECT id, client_id, message_text, sender_is_bot, timestamp "
+        f"FROM tg_messages WHERE {MESSAGE_VECTOR} @@ {query} "
+        "AND (%s::varchar IS NULL OR client_id = (SELECT id FROM tg_clients WHERE chat_id = %s)) "
+        "AND (%s::timestamp IS NULL OR timestamp >= %s) "
+        "ORDER BY id DESC LIMIT %s), "
+        "page AS ("
+        f"SELECT *, ts_rank_cd({MESSAGE_VECTOR}, {query}) AS rank FROM hits "
+        "ORDER BY rank DESC, id DESC LIMIT %s OFFSET %s) "
+        "SELECT page.id, c.chat_id, c.name, page.sender_is_bot, page.timestamp, page.rank, "
+        f"ts_headline('russian', page.message_text, {query}, "
+        "'StartSel=«, StopSel=», MaxWords=25, MinWords=10, MaxFragments=2') AS snippet "
+        "FROM page JOIN tg_clients c ON c.id = page.client_id ORDER BY page.rank DESC, page.id DESC;",
+        (text, chat_id, chat_id, since, since, candidates, text, limit + 1, offset, text)
+    )
+    columns = [column.name for column in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
@@ -1,16 +1,34 @@
 import os
 import json
-import requests
-import psycopg2
 import hmac
 import hashlib
+import time
+import datetime
 from io import BytesIO
+from functools import wraps, lru_cache
 from urllib.parse import unquote
 
 # Импорты Flask для работы с веб-сервером
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, g, Response, stream_with_context
 from dotenv import load_dotenv
 
+from db import db_cursor, on_commit
+from migrations import ensure_schema, init_schema, TELEGRAM_MIGRATIONS
+from dispatcher import create_pool
+from outbound import OutboundClient
+from cache import LRUCache
+from events import EventHub, sse_stream
+from voice_relay import VoiceRelay, VoiceCache
+from dialog import Dialog, DIALOG_STEPS, save_turn, upsert_client
+from dedup import Deduplicator
+from metrics import REGISTRY, timed
+from archive import MessageArchive
+from writer import BufferedWriter
+from search import search_clients, search_messages
+from export import ExportSlots, stream_query, format_rows
+from campaigns import (CampaignRunner, CAMPAIGN_ACTIONS, count_targets, create_campaign,
+                       list_campaigns, change_campaign_status)
+
 # --- ИНИЦИАЛИЗАЦИЯ И КОНФИГУРАЦИЯ ---
 app = Flask(__name__)
 load_dotenv()
@@ -19,168 +37,616 @@ TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 DATABASE_URL = os.environ.get("DATABASE_URL")
 MANAGER_CHAT_ID = os.environ.get("MANAGER_CHAT_ID")
 MANAGER_PASSWORD = os.environ.get("MANAGER_PASSWORD")
+# Несколько менеджеров задаются через запятую: MANAGER_CHAT_IDS="111,222".
+# Старая переменная MANAGER_CHAT_ID с одним менеджером тоже поддерживается.
+MANAGER_CHAT_IDS = frozenset(
+    chat_id.strip() for chat_id in (os.environ.get("MANAGER_CHAT_IDS") or MANAGER_CHAT_ID or "").split(",")
+    if chat_id.strip()
+)
 
 # Проверка, что все переменные окружения установлены
-if not all([TELEGRAM_BOT_TOKEN, DATABASE_URL, MANAGER_CHAT_ID, MANAGER_PASSWORD]):
+if not all([TELEGRAM_BOT_TOKEN, DATABASE_URL, MANAGER_CHAT_IDS, MANAGER_PASSWORD]):
     raise ValueError("Одна или несколько переменных окружения не установлены. Проверьте все 4 переменные на Render.")
 
 # --- API URL-адреса Telegram ---
-TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
-TELEGRAM_FILE_URL = f"https://api.telegram.org/file/bot{TELEGRAM_BOT_TOKEN}"
-
-manager_sessions = {}
+# TELEGRAM_API_BASE можно направить на локальную заглушку API (нагрузочные тесты)
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+TELEGRAM_API_URL = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}"
+TELEGRAM_FILE_URL = f"{TELEGRAM_API_BASE}/file/bot{TELEGRAM_BOT_TOKEN}"
+
+# Размеры страниц списка клиентов и истории чата в дашборде
+CLIENTS_PAGE_SIZE = 50
+CLIENTS_PAGE_MAX = 200
+HISTORY_PAGE_SIZE = 30
+HISTORY_PAGE_MAX = 100
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+
+# --- ДИАЛОГ С КЛИЕНТОМ ---
+# Шаги сценария общие с WhatsApp (dialog.py), здесь только тексты канала.
+DIALOG_TEXTS = {
+    "greeting": "Здравствуйте, {name}! Я помогу вам подобрать автомобиль. Начнем?",
+    "ask_budget": "Какой у вас бюджет в долларах? (например, 25000)",
+    "declined": "Хорошо, если передумаете, просто напишите.",
+    "ask_car_type": "Принято. Какой тип кузова вас интересует?",
+    "budget_digits_only": "Пожалуйста, введите бюджет только цифрами.",
+    "summary": "Спасибо! Ваш запрос записан:\n\n*Тип авто*: {message}\n*Бюджет*: до ${budget}\n\nНаш менеджер скоро с вами свяжется.",
+    "new_lead": "Новый запрос от {name} (`{client_key}`)\nБюджет: до ${budget}\nТип: {message}",
+}
+DIALOG_KEYBOARDS = {
+    "yes_no": {"keyboard": [[{"text": "Да"}], [{"text": "Нет"}]], "one_time_keyboard": True, "resize_keyboard": True},
+}
+client_dialog = Dialog(DIALOG_STEPS, DIALOG_TEXTS, DIALOG_KEYBOARDS, channel="telegram")
+
+# --- КЭШ КЛИЕНТОВ ---
+# Строки tg_clients по chat_id, чтобы обычный шаг диалога обходился без SELECT.
+# Кэш свой у каждого воркера, поэтому запись в БД проверяет, что dialog_step и
+# managed_by_manager не поменялись в другом процессе (см. dialog.save_turn).
+CLIENT_CACHE_FIELDS = ("id", "dialog_step", "managed_by_manager", "budget")
+CLIENT_SAVE_ATTEMPTS = 3
+client_cache = LRUCache(
+    maxsize=int(os.environ.get("CLIENT_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("CLIENT_CACHE_TTL", "300")),
+)
+
+# --- ДОЛГИЕ ОТВЕТЫ ---
+# Поток SSE и потоковая выгрузка держат поток gthread все время ответа. Вместе
+# они занимают не больше GUNICORN_THREADS - WEBHOOK_RESERVED_THREADS потоков
+# воркера, остальные всегда свободны для /webhook и обычных запросов API.
+WORKER_THREADS = int(os.environ.get("GUNICORN_THREADS", "16"))
+STREAM_THREADS = max(2, WORKER_THREADS - int(os.environ.get("WEBHOOK_RESERVED_THREADS", "4")))
+EXPORT_MAX_CONCURRENT = min(int(os.environ.get("EXPORT_MAX_CONCURRENT", "2")), STREAM_THREADS // 2)
+SSE_MAX_SUBSCRIBERS = min(int(os.environ.get("SSE_MAX_SUBSCRIBERS", str(STREAM_THREADS))),
+                          STREAM_THREADS - EXPORT_MAX_CONCURRENT)
+if WORKER_THREADS - STREAM_THREADS < 2:
+    print(f"GUNICORN_THREADS={WORKER_THREADS}: SSE и выгрузки могут занять почти все потоки воркера")
+
+# --- ЖИВЫЕ ОБНОВЛЕНИЯ ДАШБОРДА ---
+# Один LISTEN на воркер раздает события из триггеров БД всем открытым дашбордам.
+event_hub = EventHub(
+    "tg_events",
+    buffer_size=int(os.environ.get("SSE_BUFFER_SIZE", "100")),
+    max_subscribers=SSE_MAX_SUBSCRIBERS,
+)
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", "15"))
+
+# --- ИСХОДЯЩИЕ СООБЩЕНИЯ ---
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около 1 в секунду в один чат.
+# TELEGRAM_GLOBAL_RATE — лимит на всего бота, а ведро свое у каждого процесса,
+# поэтому он делится на число воркеров gunicorn (WEB_CONCURRENCY, как в gunicorn.conf.py).
+OUTBOUND_PROCESSES = max(1, int(os.environ.get("WEB_CONCURRENCY", "2")))
+telegram_outbound = OutboundClient(
+    "telegram",
+    global_rate=float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30")) / OUTBOUND_PROCESSES,
+    per_key_rate=float(os.environ.get("TELEGRAM_CHAT_RATE", "1")),
+    per_key_burst=3,
+    workers=int(os.environ.get("OUTBOUND_WORKERS", "8")),
+    # Скачивание и загрузка голосовых (VOICE_RELAY_MODE=stream, VOICE_CACHE_DIR)
+    io_workers=int(os.environ.get("OUTBOUND_IO_WORKERS", "4")),
+)
+
+# --- ФОНОВАЯ ОБРАБОТКА АПДЕЙТОВ ---
+# INGEST_MODE=sync — обработка прямо в HTTP-запросе (как раньше);
+# INGEST_MODE=queue — вебхук только ставит апдейт в очередь и сразу отвечает 200.
+INGEST_MODE = os.environ.get("INGEST_MODE", "sync")
+update_workers = create_pool(
+    "tg-updates",
+    workers=int(os.environ.get("INGEST_WORKERS", "4")),
+    queue_size=int(os.environ.get("INGEST_QUEUE_SIZE", "1000")),
+)
+
+# --- ОТСЕВ ПОВТОРНЫХ ДОСТАВОК ---
+# Telegram повторяет вебхук при таймауте или ошибке, и один update_id может
+# прийти дважды (в том числе в разные воркеры). Повтор отбрасывается до любой
+# другой работы с БД, иначе клиент получил бы ответ бота дважды.
+update_dedup = Deduplicator(
+    "telegram",
+    cache_size=int(os.environ.get("DEDUP_CACHE_SIZE", "50000")),
+    retention_hours=int(os.environ.get("DEDUP_RETENTION_HOURS", "48")),
+    cleanup_every=int(os.environ.get("DEDUP_CLEANUP_EVERY", "1000")),
+)
+
+# --- ГРУППОВАЯ ЗАПИСЬ СООБЩЕНИЙ ---
+# MESSAGE_DURABILITY: sync — сообщения пишутся в транзакции обработчика;
+# group — пачками, обработчик ждет коммита; async — пачками без ожидания
+# (см. writer.py). Ход со сменой шага в обоих буферизованных режимах уходит в
+# пачку целиком и ждет ее коммита (dialog.save_turn), голосовые и история
+# рассылок — после коммита своей транзакции (db.on_commit). Пачка пишется при MESSAGE_FLUSH_ROWS строках или через
+# MESSAGE_FLUSH_MS после первой строки.
+message_writer = BufferedWriter(
+    "tg_messages", ("client_id", "message_text", "sender_is_bot", "is_voice"),
+    defaults={"is_voice": False},
+    durability=os.environ.get("MESSAGE_DURABILITY", "sync"),
+    max_rows=int(os.environ.get("MESSAGE_FLUSH_ROWS", "500")),
+    max_delay=float(os.environ.get("MESSAGE_FLUSH_MS", "20")) / 1000,
+)
+
+# --- СЕКЦИИ И АРХИВ СООБЩЕНИЙ ---
+# tg_messages разбита на помесячные секции. Месяцы старше MESSAGES_HOT_MONTHS
+# выгружаются в ARCHIVE_DIR (gzip JSONL) и удаляются из БД; без ARCHIVE_DIR
+# фоновый поток только создает секции наперед.
+message_archive = MessageArchive(
+    "tg_messages",
+    directory=os.environ.get("ARCHIVE_DIR"),
+    hot_months=int(os.environ.get("MESSAGES_HOT_MONTHS", "6")),
+    interval=float(os.environ.get("ARCHIVE_INTERVAL", "3600")),
+)
+
+# --- ВЫГРУЗКИ ---
+# Выгрузка идет потоком через серверный курсор и держит соединение из пула
+# до конца загрузки, поэтому одновременных выгрузок на воркер немного.
+export_slots = ExportSlots(EXPORT_MAX_CONCURRENT)
+EXPORT_FORMATS = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson; charset=utf-8"}
+
+# --- РАССЫЛКИ ---
+# Получатели и их статусы хранятся в БД, отправка идет фоновым потоком пачками
+# и продолжается с того же места после перезапуска (см. campaigns.py).
+# CAMPAIGN_RATE — темп рассылки на всего бота (ее шлет один процесс), он не
+# входит в TELEGRAM_GLOBAL_RATE ответов и не урезается долей воркера.
+campaign_runner = CampaignRunner(
+    telegram_outbound, TELEGRAM_API_URL,
+    rate=float(os.environ.get("CAMPAIGN_RATE", "25")),
+    batch_size=int(os.environ.get("CAMPAIGN_BATCH_SIZE", "100")),
+    workers=int(os.environ.get("CAMPAIGN_WORKERS", "16")),
+    writer=message_writer,
+)
+CAMPAIGN_FILTERS = ("status", "car_type", "budget_min", "budget_max")
+
+@app.before_request
+def start_background_jobs():
+    # Схема проверяется один раз на процесс; после preload в мастере — без запроса к БД
+    ensure_schema("telegram", TELEGRAM_MIGRATIONS)
+    message_archive.ensure_started()
+    campaign_runner.ensure_started()
+
+# --- МЕТРИКИ ---
+# /metrics отдает их в формате Prometheus; METRICS_TOKEN закрывает эндпоинт токеном.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+WEBHOOK_SECONDS = REGISTRY.histogram("webhook_duration_seconds", "Время ответа на вебхук", ["bot"])
+UPDATE_SECONDS = REGISTRY.histogram("update_processing_seconds", "Время обработки одного апдейта", ["bot"])
+WEBHOOK_ERRORS = REGISTRY.counter("webhook_errors_total", "Вебхуки, завершившиеся ошибкой", ["bot"])
+REGISTRY.register_stats("client_cache", client_cache.stats, bot="telegram")
+REGISTRY.register_stats("dedup", update_dedup.stats, bot="telegram")
+REGISTRY.register_stats("ingest", update_workers.stats, bot="telegram")
+REGISTRY.register_stats("outbound", telegram_outbound.stats, api="telegram")
+REGISTRY.register_stats("event_hub", event_hub.stats, bot="telegram")
+REGISTRY.register_stats("message_archive", message_archive.stats, bot="telegram")
+REGISTRY.register_stats("campaigns", campaign_runner.stats, bot="telegram")
+REGISTRY.register_stats("message_writer", message_writer.stats, bot="telegram")
 
 # --- РАБОТА С БАЗОЙ ДАННЫХ ---
-def get_db_connection():
-    """Создает соединение с базой данных."""
-    conn = psycopg2.connect(DATABASE_URL)
-    return conn
-
+# Соединения берутся из общего пула (db.py), а не открываются на каждый вызов.
 def init_db():
-    """Создает таблицы в базе данных, если они не существуют."""
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        # Создание таблицы клиентов
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS tg_clients (
-                id SERIAL PRIMARY KEY,
-                chat_id VARCHAR(50) UNIQUE NOT NULL,
-                name VARCHAR(100),
-                status VARCHAR(50) DEFAULT 'new',
-                managed_by_manager BOOLEAN DEFAULT FALSE,
-                dialog_step VARCHAR(50) DEFAULT 'start',
-                budget VARCHAR(100),
-                car_type VARCHAR(100)
-            );
-        ''')
-        # Создание таблицы сообщений
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS tg_messages (
-                id SERIAL PRIMARY KEY,
-                client_id INTEGER REFERENCES tg_clients(id),
-                message_text TEXT,
-                is_voice BOOLEAN DEFAULT FALSE,
-                sender_is_bot BOOLEAN,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        ''')
-        conn.commit()
-        cur.close()
-        conn.close()
-        print("База данных успешно инициализирована.")
-    except Exception as e:
-        print(f"Ошибка при инициализации базы данных: {e}")
+    """Применяет недостающие миграции схемы (см. migrations.init_schema)."""
+    return init_schema("telegram", TELEGRAM_MIGRATIONS)
 
 # --- ФУНКЦИИ ДЛЯ РАБОТЫ С TELEGRAM API ---
 def send_telegram_message(text, chat_id, keyboard=None):
-    """Отправляет текстовое сообщение. Может прикреплять клавиатуру."""
+    """Ставит текстовое сообщение в очередь отправки. Может прикреплять клавиатуру."""
     url = f"{TELEGRAM_API_URL}/sendMessage"
     payload = {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}
     if keyboard:
         payload["reply_markup"] = json.dumps(keyboard)
-    
-    headers = {"Content-Type": "application/json"}
-    try:
-        requests.post(url, headers=headers, data=json.dumps(payload), timeout=10).raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при отправке текстового сообщения: {e}")
-
-def send_voice_message(voice_content, chat_id, caption=""):
-    """Отправляет голосовое сообщение."""
-    url = f"{TELEGRAM_API_URL}/sendVoice"
-    files = {'voice': ('voice_message.ogg', voice_content, 'audio/ogg')}
-    data = {'chat_id': chat_id, 'caption': caption}
-    try:
-        requests.post(url, files=files, data=data, timeout=10).raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при отправке голосового сообщения: {e}")
-
-def get_file_content(file_id):
-    """Скачивает файл (голосовое сообщение) с серверов Telegram."""
-    try:
-        url = f"{TELEGRAM_API_URL}/getFile?file_id={file_id}"
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        file_path = response.json()['result']['file_path']
-        
-        download_url = f"{TELEGRAM_FILE_URL}/{file_path}"
-        file_response = requests.get(download_url, timeout=10)
-        file_response.raise_for_status()
-        return file_response.content
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при скачивании файла: {e}")
-        return None
+    telegram_outbound.post_async(chat_id, url, json=payload)
+
+# --- ПЕРЕСЫЛКА ГОЛОСОВЫХ ---
+# VOICE_RELAY_MODE=file_id — переотправка по file_id без скачивания;
+# VOICE_RELAY_MODE=stream — потоковая перекачка файла через сервер.
+# VOICE_CACHE_DIR включает дисковый кэш копий размером до VOICE_CACHE_MAX_BYTES.
+VOICE_CACHE_DIR = os.environ.get("VOICE_CACHE_DIR")
+voice_relay = VoiceRelay(
+    telegram_outbound, TELEGRAM_API_URL, TELEGRAM_FILE_URL,
+    mode=os.environ.get("VOICE_RELAY_MODE", "file_id"),
+    cache=VoiceCache(VOICE_CACHE_DIR, int(os.environ.get("VOICE_CACHE_MAX_BYTES", str(512 * 1024 * 1024))))
+    if VOICE_CACHE_DIR else None,
+)
 
 # --- БЕЗОПАСНОСТЬ MINI APP ---
+# initData живет INIT_DATA_MAX_AGE секунд с момента auth_date. Уже проверенные
+# строки кэшируются, чтобы запросы дашборда из одной сессии не пересчитывали HMAC.
+INIT_DATA_MAX_AGE = int(os.environ.get("INIT_DATA_MAX_AGE", "86400"))
+init_data_cache = LRUCache(
+    maxsize=int(os.environ.get("INIT_DATA_CACHE_SIZE", "1000")),
+    ttl=float(os.environ.get("INIT_DATA_CACHE_TTL", "600")),
+)
+REGISTRY.register_stats("init_data_cache", init_data_cache.stats, bot="telegram")
+
+@lru_cache(maxsize=4)
+def webapp_secret_key(bot_token):
+    """Ключ проверки initData зависит только от токена бота, считаем его один раз."""
+    return hmac.new("WebAppData".encode(), bot_token.encode(), hashlib.sha256).digest()
+
 def validate_init_data(init_data, bot_token):
-    """Проверяет подлинность данных от Telegram Mini App."""
+    """Проверяет подлинность и свежесть данных от Telegram Mini App."""
+    cache_key = hashlib.sha256(f"{bot_token}\n{init_data}".encode()).digest()
+    cached = init_data_cache.get(cache_key)
+    if cached is not None:
+        user_data, auth_date = cached
+        if time.time() - auth_date <= INIT_DATA_MAX_AGE:
+            return user_data
+        init_data_cache.invalidate(cache_key)
+        return None
+
     try:
-        secret_key = hmac.new("WebAppData".encode(), bot_token.encode(), hashlib.sha256).digest()
         data_check_string = []
         hash_str = ''
         params = sorted([x.split('=', 1) for x in init_data.split('&')])
-        
+
         for key, value in params:
             if key == 'hash':
                 hash_str = value
             else:
                 data_check_string.append(f"{key}={unquote(value)}")
-        
+
         data_check_string = "\n".join(data_check_string)
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        
-        if calculated_hash == hash_str:
-            for key, value in params:
-                if key == 'user':
-                    user_data = json.loads(unquote(value))
-                    return user_data
+        calculated_hash = hmac.new(webapp_secret_key(bot_token), data_check_string.encode(), hashlib.sha256).hexdigest()
+
+        if hmac.compare_digest(calculated_hash, hash_str):
+            fields = dict(params)
+            auth_date = int(fields.get('auth_date', 0))
+            age = time.time() - auth_date
+            if age > INIT_DATA_MAX_AGE:
+                print("Ошибка валидации: initData устарели")
+                return None
+            if 'user' in fields:
+                user_data = json.loads(unquote(fields['user']))
+                # Запись в кэше не должна пережить сами initData
+                init_data_cache.set(cache_key, (user_data, auth_date),
+                                    ttl=min(init_data_cache.ttl, INIT_DATA_MAX_AGE - age))
+                return user_data
     except Exception as e:
         print(f"Ошибка валидации: {e}")
     return None
 
 # --- МАРШРУТЫ ДЛЯ MINI APP ---
+# initData в параметре tma попадает в URL и логи прокси, поэтому так его принимают
+# только GET-запросы, которым нельзя передать заголовок: EventSource и ссылки выгрузок.
+QUERY_AUTH_ENDPOINTS = {"events_api", "export_clients_api", "export_messages_api"}
+
+def manager_required(f):
+    """Пускает к API дашборда только менеджера с валидными initData Telegram."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth_header = request.headers.get('Authorization')
+        if (not auth_header and request.args.get('tma') and request.method == 'GET'
+                and request.endpoint in QUERY_AUTH_ENDPOINTS):
+            # EventSource не умеет отправлять заголовки, initData приходит в параметре
+            auth_header = 'tma ' + request.args['tma']
+        if not auth_header or not auth_header.startswith('tma '):
+            return jsonify({"error": "Нет данных для авторизации"}), 401
+
+        init_data = auth_header.split(' ', 1)[1]
+        user_data = validate_init_data(init_data, TELEGRAM_BOT_TOKEN)
+
+        if not user_data or str(user_data.get('id')) not in MANAGER_CHAT_IDS:
+            return jsonify({"error": "Доступ запрещен"}), 403
+        g.manager = user_data
+        return f(*args, **kwargs)
+    return decorated_function
+
 @app.route('/manager-dashboard')
 def manager_dashboard():
     """Отдает HTML-файл дашборда."""
     return send_from_directory('.', 'manager.html')
 
+def client_filters(alias=""):
+    """Условия WHERE и параметры по фильтрам status и q (имя или chat_id) из запроса.
+
+    alias — префикс столбцов tg_clients в запросе ("c."). Спецсимволы LIKE в q
+    экранируются: поиск идет по подстроке как есть.
+    """
+    status = request.args.get('status')
+    search = request.args.get('q', '').strip()
+    conditions, params = [], []
+    if status:
+        conditions.append(f"{alias}status = %s")
+        params.append(status)
+    if search:
+        pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        conditions.append(f"({alias}name ILIKE %s OR {alias}chat_id LIKE %s)")
+        params += [pattern, pattern]
+    return conditions, params
+
 @app.route('/api/clients')
+@manager_required
 def get_clients_api():
-    """Отдает список клиентов, но только авторизованному менеджеру."""
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('tma '):
-        return jsonify({"error": "Нет данных для авторизации"}), 401
-
-    init_data = auth_header.split(' ', 1)[1]
-    user_data = validate_init_data(init_data, TELEGRAM_BOT_TOKEN)
-
-    if not user_data or str(user_data.get('id')) != MANAGER_CHAT_ID:
-        return jsonify({"error": "Доступ запрещен"}), 403
-
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT chat_id, name, status FROM tg_clients ORDER BY id DESC;")
-    clients_data = cur.fetchall()
-    cur.close()
-    conn.close()
-    
-    client_list = [{"chat_id": row[0], "name": row[1], "status": row[2]} for row in clients_data]
-    return jsonify(client_list)
+    """Отдает страницу клиентов (новые сверху) с фильтрами и поддержкой If-None-Match.
+
+    Параметры: limit, before_id (курсор из next_cursor), status, q (имя или chat_id).
+    ETag строится по счетчику изменений списка клиентов, который миграция 3
+    увеличивает при появлении клиента или смене его имени/статуса.
+    """
+    limit = min(max(request.args.get('limit', CLIENTS_PAGE_SIZE, type=int), 1), CLIENTS_PAGE_MAX)
+    before_id = request.args.get('before_id', type=int)
+
+    with db_cursor() as cur:
+        cur.execute("SELECT value FROM change_counters WHERE name = 'tg_clients';")
+        counter = cur.fetchone()
+        query_hash = hashlib.sha1(request.query_string).hexdigest()[:12]
+        etag = f"{counter[0] if counter else 0}-{query_hash}"
+        if request.if_none_match.contains(etag):
+            return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+
+        conditions, params = client_filters()
+        if before_id:
+            conditions.append("id < %s")
+            params.append(before_id)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        # Берем на одну строку больше, чтобы понять, есть ли следующая страница
+        cur.execute(f"SELECT id, chat_id, name, status FROM tg_clients {where}ORDER BY id DESC LIMIT %s;",
+                    params + [limit + 1])
+        clients_data = cur.fetchall()
+
+    has_more = len(clients_data) > limit
+    clients_data = clients_data[:limit]
+    client_list = [{"id": row[0], "chat_id": row[1], "name": row[2], "status": row[3]} for row in clients_data]
+    response = jsonify({"clients": client_list, "next_cursor": client_list[-1]["id"] if has_more else None})
+    response.headers['ETag'] = f'"{etag}"'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/history')
+@manager_required
+def get_history_api():
+    """Отдает страницу истории чата клиента: последние сообщения, по возрастанию id.
+
+    Параметры: chat_id, limit, before_id (курсор из next_cursor для «загрузить ранние»).
+    Когда сообщения в БД заканчиваются, страница дочитывается из архива.
+    """
+    chat_id = request.args.get('chat_id', '').strip()
+    if not chat_id:
+        return jsonify({"error": "Не указан chat_id"}), 400
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_PAGE_MAX)
+    before_id = request.args.get('before_id', type=int)
+
+    with db_cursor() as cur:
+        cur.execute("SELECT id FROM tg_clients WHERE chat_id = %s;", (chat_id,))
+        client = cur.fetchone()
+        if not client:
+            return jsonify({"error": "Клиент не найден"}), 404
+        # Обход индекса (client_id, id) с конца: читается ровно одна страница
+        cur.execute(
+            "SELECT id, message_text, sender_is_bot, is_voice, timestamp FROM tg_messages "
+            "WHERE client_id = %s AND (%s::int IS NULL OR id < %s) ORDER BY id DESC LIMIT %s;",
+            (client[0], before_id, before_id, limit + 1)
+        )
+        rows = cur.fetchall()
+
+    if len(rows) <= limit:
+        cursor_id = rows[-1][0] if rows else before_id
+        rows += [(row["id"], row["message_text"], row["sender_is_bot"], row["is_voice"], row["timestamp"])
+                 for row in message_archive.read(client[0], cursor_id, limit + 1 - len(rows))]
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    messages = [serialize_message(row) for row in reversed(rows)]
+    return jsonify({"messages": messages, "next_cursor": rows[-1][0] if has_more else None})
+
+@app.route('/api/search')
+@manager_required
+def search_api():
+    """Поиск клиентов (имя, тип авто, chat_id) и сообщений (текст) с ранжированием.
+
+    Параметры: q, scope (all|clients|messages), limit, offset (из next_offset),
+    chat_id и since (ISO-дата) сужают поиск по сообщениям.
+    """
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({"error": "Не указан q"}), 400
+    scope = request.args.get('scope', 'all')
+    if scope not in ('all', 'clients', 'messages'):
+        return jsonify({"error": "scope: all, clients или messages"}), 400
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), SEARCH_PAGE_MAX)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    chat_id = request.args.get('chat_id', '').strip() or None
+    since = request.args.get('since', '').strip() or None
+    if since:
+        try:
+            datetime.datetime.fromisoformat(since)
+        except ValueError:
+            return jsonify({"error": f"Некорректная дата: {since}"}), 400
+
+    result = {}
+    with db_cursor() as cur:
+        if scope in ('all', 'clients'):
+            result["clients"] = search_clients(cur, text, limit, offset)
+        if scope in ('all', 'messages'):
+            result["messages"] = search_messages(cur, text, limit, offset, chat_id, since)
+    response = {}
+    for name, rows in result.items():
+        for row in rows:
+            row["rank"] = round(row["rank"], 4)
+            if "timestamp" in row:
+                row["timestamp"] = row["timestamp"].isoformat()
+        response[name] = {"items": rows[:limit], "next_offset": offset + limit if len(rows) > limit else None}
+    return jsonify(response)
+
+@app.route('/api/send_message', methods=['POST'])
+@manager_required
+def send_message_api():
+    """Сохраняет сообщение менеджера и ставит его в очередь отправки клиенту."""
+    data = request.get_json(silent=True) or {}
+    chat_id = str(data.get('chat_id', '')).strip()
+    text = str(data.get('text', '')).strip()
+    if not chat_id or not text:
+        return jsonify({"error": "Нужны chat_id и text"}), 400
+
+    # Пишется напрямую, а не через message_writer: дашборду нужны id и время строки,
+    # чтобы не показать сообщение второй раз, когда то же событие придет по SSE
+    with db_cursor() as cur:
+        cur.execute(
+            "INSERT INTO tg_messages (client_id, message_text, sender_is_bot) "
+            "SELECT id, %s, TRUE FROM tg_clients WHERE chat_id = %s "
+            "RETURNING id, message_text, sender_is_bot, is_voice, timestamp;", (text, chat_id)
+        )
+        row = cur.fetchone()
+    if not row:
+        return jsonify({"error": "Клиент не найден"}), 404
+
+    send_telegram_message(text, chat_id)
+    return jsonify({"status": "queued", "message": serialize_message(row)}), 202
+
+@app.route('/api/campaigns', methods=['GET', 'POST'])
+@manager_required
+def campaigns_api():
+    """GET — последние рассылки с прогрессом; POST — новая рассылка.
+
+    Тело POST: text, filters (status, car_type, budget_min, budget_max).
+    С dry_run=true рассылка не создается, возвращается только число получателей.
+    """
+    if request.method == 'GET':
+        with db_cursor() as cur:
+            campaigns = list_campaigns(cur)
+        for campaign in campaigns:
+            for field in ("created_at", "finished_at"):
+                campaign[field] = campaign[field].isoformat() if campaign[field] else None
+        return jsonify({"campaigns": campaigns})
+
+    data = request.get_json(silent=True) or {}
+    text = str(data.get('text', '')).strip()
+    raw_filters = data.get('filters') or {}
+    if not isinstance(raw_filters, dict):
+        return jsonify({"error": "filters должен быть объектом"}), 400
+    filters = {key: raw_filters[key] for key in CAMPAIGN_FILTERS if raw_filters.get(key) not in (None, "")}
+    try:
+        for key in ("budget_min", "budget_max"):
+            if key in filters:
+                filters[key] = int(filters[key])
+    except (TypeError, ValueError):
+        return jsonify({"error": "Бюджет указывается числом"}), 400
+
+    with db_cursor() as cur:
+        if data.get('dry_run'):
+            return jsonify({"recipients": count_targets(cur, filters)})
+        if not text:
+            return jsonify({"error": "Не указан text"}), 400
+        campaign_id, total = create_campaign(cur, text, filters, created_by=str(g.manager.get('id')))
+    return jsonify({"id": campaign_id, "recipients": total, "status": "running"}), 201
+
+@app.route('/api/campaigns/<int:campaign_id>/<action>', methods=['POST'])
+@manager_required
+def campaign_action_api(campaign_id, action):
+    """Пауза (pause), продолжение (resume) или отмена (cancel) рассылки."""
+    if action not in CAMPAIGN_ACTIONS:
+        return jsonify({"error": "Неизвестное действие"}), 404
+    with db_cursor() as cur:
+        changed = change_campaign_status(cur, campaign_id, action)
+    if not changed:
+        return jsonify({"error": "Рассылка не найдена или уже в другом статусе"}), 409
+    return jsonify({"id": campaign_id, "status": CAMPAIGN_ACTIONS[action][1]})
+
+@app.route('/api/events')
+@manager_required
+def events_api():
+    """Поток Server-Sent Events с изменениями клиентов и новыми сообщениями.
+
+    Каждое подключение занимает поток воркера gthread на все время, поэтому
+    число подключений ограничено SSE_MAX_SUBSCRIBERS (см. «Долгие ответы»).
+    """
+    subscriber = event_hub.subscribe()
+    if subscriber is None:
+        return jsonify({"error": "Слишком много подключений"}), 503
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(sse_stream(event_hub, subscriber, SSE_HEARTBEAT)),
+                    mimetype='text/event-stream', headers=headers)
+
+def export_response(name, query, params, columns):
+    """Потоковый ответ с выгрузкой в формате из параметра format (csv или jsonl)."""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "format: csv или jsonl"}), 400
+    if not export_slots.acquire():
+        return jsonify({"error": "Слишком много выгрузок, повторите позже"}), 503, {'Retry-After': '30'}
+    try:
+        chunks = format_rows(stream_query(query, params), columns, fmt, name)
+        response = Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[fmt], headers={
+            'Content-Disposition': f'attachment; filename="{name}-{time.strftime("%Y%m%d-%H%M%S")}.{fmt}"',
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no',
+        })
+    except Exception:
+        export_slots.release()
+        raise
+    # Слот освобождается, когда ответ дочитан или соединение с клиентом оборвалось
+    response.call_on_close(export_slots.release)
+    return response
+
+@app.route('/api/export/clients')
+@manager_required
+def export_clients_api():
+    """Выгрузка всех клиентов (с бюджетом, типом авто и закрепленным менеджером).
+
+    Параметры: format (csv|jsonl), status, q — те же фильтры, что у /api/clients.
+    """
+    conditions, params = client_filters("c.")
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    return export_response(
+        "clients",
+        "SELECT c.id, c.chat_id, c.name, c.status, c.budget, c.car_type, c.dialog_step, "
+        "c.managed_by_manager, a.manager_chat_id FROM tg_clients c "
+        f"LEFT JOIN manager_assignments a ON a.client_id = c.id {where}ORDER BY c.id;",
+        params,
+        ["id", "chat_id", "name", "status", "budget", "car_type", "dialog_step",
+         "managed_by_manager", "manager_chat_id"],
+    )
+
+@app.route('/api/export/messages')
+@manager_required
+def export_messages_api():
+    """Выгрузка сообщений из БД в порядке id.
+
+    Параметры: format (csv|jsonl), chat_id (один клиент), since и until (ISO-дата
+    или время; по ним Postgres читает только нужные месячные секции). Месяцы,
+    уже выгруженные в архив, в выгрузку не попадают.
+    """
+    chat_id = request.args.get('chat_id', '').strip()
+    since = request.args.get('since', '').strip()
+    until = request.args.get('until', '').strip()
+    conditions, params = [], []
+    for value in (since, until):
+        if value:
+            try:
+                datetime.datetime.fromisoformat(value)
+            except ValueError:
+                return jsonify({"error": f"Некорректная дата: {value}"}), 400
+    if chat_id:
+        conditions.append("c.chat_id = %s")
+        params.append(chat_id)
+    if since:
+        conditions.append("m.timestamp >= %s")
+        params.append(since)
+    if until:
+        conditions.append("m.timestamp < %s")
+        params.append(until)
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    return export_response(
+        "messages",
+        "SELECT m.id, c.chat_id, c.name, m.message_text, m.sender_is_bot, m.is_voice, m.timestamp "
+        f"FROM tg_messages m JOIN tg_clients c ON c.id = m.client_id {where}ORDER BY m.id;",
+        params,
+        ["id", "chat_id", "name", "message_text", "sender_is_bot", "is_voice", "timestamp"],
+    )
+
+def serialize_message(row):
+    """Превращает строку tg_messages (id, text, sender_is_bot, is_voice, timestamp) в JSON."""
+    return {
+        "id": row[0],
+        "message_text": row[1],
+        "sender_is_bot": row[2],
+        "is_voice": row[3],
+        "timestamp": row[4].isoformat() if row[4] else None,
+    }
 
 # --- ОСНОВНАЯ ЛОГИКА БОТА ---
 def send_client_history(client_chat_id, recipient_chat_id):
     """Получает историю чата клиента и отправляет ее получателю."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT m.message_text, m.sender_is_bot, m.is_voice FROM tg_messages m "
-        "JOIN tg_clients c ON m.client_id = c.id WHERE c.chat_id = %s "
-        "ORDER BY m.timestamp DESC LIMIT 20", (client_chat_id,)
-    )
-    messages = cur.fetchall()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute(
+            "SELECT m.message_text, m.sender_is_bot, m.is_voice FROM tg_messages m "
+            "JOIN tg_clients c ON m.client_id = c.id WHERE c.chat_id = %s "
+            "ORDER BY m.timestamp DESC LIMIT 20", (client_chat_id,)
+        )
+        messages = cur.fetchall()
     
     if not messages:
         history_text = f"История сообщений для клиента `{client_chat_id}` пуста."
@@ -193,198 +659,319 @@ def send_client_history(client_chat_id, recipient_chat_id):
             
     send_telegram_message(history_text, recipient_chat_id)
 
+def load_manager_session(cur, manager_chat_id):
+    """Возвращает (вошел ли менеджер, его текущий чат или None).
+
+    Текущий чат возвращается, только если клиент все еще закреплен за этим
+    менеджером. Оба поиска идут по первичным ключам.
+    """
+    cur.execute(
+        "SELECT CASE WHEN a.client_id IS NOT NULL THEN s.active_chat_id END FROM manager_sessions s "
+        "LEFT JOIN tg_clients c ON c.chat_id = s.active_chat_id "
+        "LEFT JOIN manager_assignments a ON a.client_id = c.id AND a.manager_chat_id = s.manager_chat_id "
+        "WHERE s.manager_chat_id = %s;", (manager_chat_id,)
+    )
+    row = cur.fetchone()
+    return (True, row[0]) if row else (False, None)
+
+def assign_client(cur, client_chat_id, manager_chat_id):
+    """Закрепляет клиента за менеджером и делает его текущим чатом менеджера.
+
+    Меняются только строки этого клиента и этого менеджера. Возвращает
+    (имя клиента, chat_id прежнего менеджера) или None, если клиента нет.
+    """
+    cur.execute(
+        "WITH target AS (SELECT id, name FROM tg_clients WHERE chat_id = %s), "
+        "previous AS (SELECT manager_chat_id FROM manager_assignments WHERE client_id = (SELECT id FROM target)), "
+        "assigned AS (INSERT INTO manager_assignments (client_id, manager_chat_id) SELECT id, %s FROM target "
+        "ON CONFLICT (client_id) DO UPDATE SET manager_chat_id = EXCLUDED.manager_chat_id, assigned_at = CURRENT_TIMESTAMP "
+        "RETURNING client_id), "
+        "flagged AS (UPDATE tg_clients SET managed_by_manager = TRUE WHERE id IN (SELECT client_id FROM assigned) "
+        "AND managed_by_manager IS NOT TRUE RETURNING id) "
+        "SELECT name, (SELECT manager_chat_id FROM previous) FROM target;",
+        (client_chat_id, manager_chat_id)
+    )
+    row = cur.fetchone()
+    if row:
+        cur.execute("UPDATE manager_sessions SET active_chat_id = %s WHERE manager_chat_id = %s;",
+                    (client_chat_id, manager_chat_id))
+        client_cache.invalidate(client_chat_id)
+    return row
+
+def release_client(cur, client_chat_id, manager_chat_id):
+    """Возвращает клиента боту. Возвращает имя клиента или None, если он не закреплен за менеджером.
+
+    Клиентов, помеченных managed_by_manager еще до manager_assignments (один
+    менеджер на всех), может вернуть любой менеджер: назначения у них нет.
+    """
+    cur.execute(
+        "WITH released AS (DELETE FROM manager_assignments a USING tg_clients c "
+        "WHERE a.client_id = c.id AND c.chat_id = %s AND a.manager_chat_id = %s RETURNING a.client_id), "
+        "unassigned AS (SELECT id FROM tg_clients c WHERE chat_id = %s AND managed_by_manager "
+        "AND NOT EXISTS (SELECT 1 FROM manager_assignments a WHERE a.client_id = c.id)), "
+        "flagged AS (UPDATE tg_clients SET managed_by_manager = FALSE "
+        "WHERE id IN (SELECT client_id FROM released UNION ALL SELECT id FROM unassigned) RETURNING name) "
+        "SELECT name FROM flagged;",
+        (client_chat_id, manager_chat_id, client_chat_id)
+    )
+    row = cur.fetchone()
+    if row:
+        cur.execute("UPDATE manager_sessions SET active_chat_id = NULL WHERE manager_chat_id = %s AND active_chat_id = %s;",
+                    (manager_chat_id, client_chat_id))
+        client_cache.invalidate(client_chat_id)
+    return row
+
 def process_manager_message(message_body, chat_id_str):
     """Обрабатывает все команды и сообщения от менеджера."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    if message_body.lower().startswith('/login '):
-        pwd = message_body.split(' ', 1)[1]
-        if pwd == MANAGER_PASSWORD:
-            manager_sessions[chat_id_str] = {"logged_in": True}
-            send_telegram_message("✅ Вход выполнен.\nКоманды:\n`/list`\n`/takeover <id>`\n`/history <id>`", chat_id_str)
-        else:
-            send_telegram_message("❌ Неверный пароль.", chat_id_str)
-        
-    elif not manager_sessions.get(chat_id_str, {}).get("logged_in"):
-        send_telegram_message("Пожалуйста, войдите: `/login <пароль>`", chat_id_str)
-    
-    elif message_body.lower() == '/list':
-        cur.execute("SELECT name, chat_id, status FROM tg_clients ORDER BY id DESC LIMIT 10;")
-        clients = cur.fetchall()
-        reply = "Последние 10 клиентов:\n\n" if clients else "Клиентов нет."
-        for client in clients:
-            reply += f"👤 *{client[0]}* | Статус: {client[2]}\n`{client[1]}`\n\n"
-        send_telegram_message(reply, chat_id_str)
-
-    elif message_body.lower().startswith('/takeover '):
-        try:
-            client_to_manage = message_body.split(' ', 1)[1]
-            cur.execute("UPDATE tg_clients SET managed_by_manager = FALSE;")
-            cur.execute("UPDATE tg_clients SET managed_by_manager = TRUE WHERE chat_id = %s RETURNING name;", (client_to_manage,))
-            client_name = cur.fetchone()
-            if client_name:
-                send_telegram_message(f"✅ Вы управляете чатом с {client_name[0]} (`{client_to_manage}`).", chat_id_str)
-                send_telegram_message("К вам подключился менеджер.", client_to_manage)
+    with db_cursor() as cur:
+        if message_body.lower().startswith('/login '):
+            pwd = message_body.split(' ', 1)[1]
+            if pwd == MANAGER_PASSWORD:
+                cur.execute(
+                    "INSERT INTO manager_sessions (manager_chat_id) VALUES (%s) "
+                    "ON CONFLICT (manager_chat_id) DO UPDATE SET logged_in_at = CURRENT_TIMESTAMP;", (chat_id_str,)
+                )
+                send_telegram_message("✅ Вход выполнен.\nКоманды:\n`/list`\n`/find <текст>`\n`/chats`\n`/takeover <id>`\n`/release [id]`\n`/history <id>`", chat_id_str)
+            else:
+                send_telegram_message("❌ Неверный пароль.", chat_id_str)
+            return
+
+        logged_in, active_chat_id = load_manager_session(cur, chat_id_str)
+        if not logged_in:
+            send_telegram_message("Пожалуйста, войдите: `/login <пароль>`", chat_id_str)
+
+        elif message_body.lower() == '/list':
+            cur.execute("SELECT name, chat_id, status FROM tg_clients ORDER BY id DESC LIMIT 10;")
+            clients = cur.fetchall()
+            reply = "Последние 10 клиентов:\n\n" if clients else "Клиентов нет."
+            for client in clients:
+                reply += f"👤 *{client[0]}* | Статус: {client[2]}\n`{client[1]}`\n\n"
+            send_telegram_message(reply, chat_id_str)
+
+        elif message_body.lower().startswith('/find '):
+            text = message_body.split(' ', 1)[1].strip()
+            clients = search_clients(cur, text, 5)[:5]
+            messages = search_messages(cur, text, 5)[:5]
+            reply = "" if clients or messages else "Ничего не найдено."
+            if clients:
+                reply += "Клиенты:\n\n"
+                for client in clients:
+                    reply += f"👤 *{client['name']}* | {client['car_type'] or '—'} | Статус: {client['status']}\n`{client['chat_id']}`\n\n"
+            if messages:
+                reply += "Сообщения:\n\n"
+                for message in messages:
+                    reply += f"💬 {message['name']} `{message['chat_id']}` {message['timestamp']:%d.%m.%Y}\n{message['snippet']}\n\n"
+            send_telegram_message(reply, chat_id_str)
+
+        elif message_body.lower() == '/chats':
+            cur.execute(
+                "SELECT c.name, c.chat_id FROM manager_assignments a JOIN tg_clients c ON c.id = a.client_id "
+                "WHERE a.manager_chat_id = %s ORDER BY a.assigned_at DESC LIMIT 50;", (chat_id_str,)
+            )
+            chats = cur.fetchall()
+            reply = "Ваши чаты:\n\n" if chats else "За вами нет закрепленных чатов."
+            for name, client_chat_id in chats:
+                marker = "▶️ " if client_chat_id == active_chat_id else ""
+                reply += f"{marker}*{name}* `{client_chat_id}`\n"
+            send_telegram_message(reply, chat_id_str)
+
+        elif message_body.lower().startswith('/takeover '):
+            client_to_manage = message_body.split(' ', 1)[1].strip()
+            assigned = assign_client(cur, client_to_manage, chat_id_str)
+            if assigned:
+                client_name, previous_manager = assigned
+                send_telegram_message(f"✅ Вы управляете чатом с {client_name} (`{client_to_manage}`).", chat_id_str)
+                if previous_manager is None:
+                    send_telegram_message("К вам подключился менеджер.", client_to_manage)
+                elif previous_manager != chat_id_str:
+                    send_telegram_message(f"Чат с {client_name} (`{client_to_manage}`) передан другому менеджеру.", previous_manager)
             else:
                 send_telegram_message("Клиент не найден.", chat_id_str)
-        except IndexError:
-            send_telegram_message("Используйте: `/takeover <chat_id>`", chat_id_str)
-            
-    elif message_body.lower().startswith('/history '):
-        try:
+
+        elif message_body.lower().split(' ', 1)[0] == '/release':
+            parts = message_body.split(' ', 1)
+            client_to_release = parts[1].strip() if len(parts) > 1 else active_chat_id
+            released = release_client(cur, client_to_release, chat_id_str) if client_to_release else None
+            if released:
+                send_telegram_message(f"Чат с {released[0]} (`{client_to_release}`) возвращен боту.", chat_id_str)
+            else:
+                send_telegram_message("Используйте: `/release <chat_id>` для своего чата", chat_id_str)
+
+        elif message_body.lower().startswith('/history '):
             client_chat_id = message_body.split(' ', 1)[1]
             send_client_history(client_chat_id, chat_id_str)
-        except IndexError:
-            send_telegram_message("Используйте: `/history <chat_id>`", chat_id_str)
 
-    else:
-        cur.execute("SELECT chat_id FROM tg_clients WHERE managed_by_manager = TRUE;")
-        active_client = cur.fetchone()
-        if active_client:
-            send_telegram_message(message_body, active_client[0])
+        elif active_chat_id:
+            send_telegram_message(message_body, active_chat_id)
         else:
             send_telegram_message("Нет активного чата. Используйте `/takeover <chat_id>`.", chat_id_str)
-    
-    conn.commit()
-    cur.close()
-    conn.close()
 
-def process_client_message(message_body, chat_id_str, name):
-    """Обрабатывает сообщения от клиента."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT id, dialog_step, managed_by_manager FROM tg_clients WHERE chat_id = %s;", (chat_id_str,))
-    client = cur.fetchone()
-    if not client:
-        cur.execute("INSERT INTO tg_clients (chat_id, name) VALUES (%s, %s) RETURNING id, dialog_step, managed_by_manager;", (chat_id_str, name))
-        client = cur.fetchone()
-    client_id, dialog_step, managed_by_manager = client
+def assigned_manager(cur, client_id):
+    """chat_id менеджера, за которым закреплен клиент (поиск по первичному ключу)."""
+    cur.execute("SELECT manager_chat_id FROM manager_assignments WHERE client_id = %s;", (client_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
 
-    cur.execute("INSERT INTO tg_messages (client_id, message_text, sender_is_bot) VALUES (%s, %s, FALSE);", (client_id, message_body))
+def load_client(cur, chat_id_str, name):
+    """Возвращает копию строки клиента из кэша или БД, создавая клиента при первом обращении."""
+    client = client_cache.get(chat_id_str)
+    if client is None:
+        client = dict(zip(CLIENT_CACHE_FIELDS, upsert_client(cur, "tg_clients", "chat_id", chat_id_str, name)))
+        client_cache.set(chat_id_str, client)
+    return dict(client)
 
-    if managed_by_manager:
-        manager_message = f"Сообщение от {name} (`{chat_id_str}`):\n\n{message_body}"
-        send_telegram_message(manager_message, MANAGER_CHAT_ID)
-    else:
-        user_input = message_body.lower().strip()
-        reply_text, keyboard = "", None
-        
-        if dialog_step == 'start':
-            reply_text = f"Здравствуйте, {name}! Я помогу вам подобрать автомобиль. Начнем?"
-            keyboard = {"keyboard": [[{"text": "Да"}], [{"text": "Нет"}]], "one_time_keyboard": True, "resize_keyboard": True}
-            cur.execute("UPDATE tg_clients SET dialog_step = 'ask_budget' WHERE id = %s;", (client_id,))
-        
-        elif dialog_step == 'ask_budget':
-            if user_input == 'да':
-                reply_text = "Какой у вас бюджет в долларах? (например, 25000)"
-                cur.execute("UPDATE tg_clients SET dialog_step = 'get_budget' WHERE id = %s;", (client_id,))
-            else:
-                reply_text = "Хорошо, если передумаете, просто напишите."
-                cur.execute("UPDATE tg_clients SET dialog_step = 'start' WHERE id = %s;", (client_id,))
-        
-        elif dialog_step == 'get_budget':
-            if user_input.isdigit():
-                reply_text = "Принято. Какой тип кузова вас интересует?"
-                cur.execute("UPDATE tg_clients SET budget = %s, dialog_step = 'get_car_type' WHERE id = %s;", (user_input, client_id))
+def process_client_message(message_body, chat_id_str, name):
+    """Обрабатывает сообщения от клиента."""
+    outgoing = []
+    try:
+        with db_cursor() as cur:
+            # Обычно хватает одной попытки без чтения из БД; повтор нужен,
+            # только если закэшированная строка устарела.
+            for _ in range(CLIENT_SAVE_ATTEMPTS):
+                client = load_client(cur, chat_id_str, name)
+                updates, messages, outgoing = {}, [(message_body, False)], []
+
+                if client["managed_by_manager"]:
+                    manager_message = f"Сообщение от {name} (`{chat_id_str}`):\n\n{message_body}"
+                    manager_chat_id = assigned_manager(cur, client["id"])
+                    # Флаг без назначения остался от схемы с одним менеджером: пишем всем
+                    for recipient in [manager_chat_id] if manager_chat_id else MANAGER_CHAT_IDS:
+                        outgoing.append((manager_message, recipient, None))
+                else:
+                    outcome = client_dialog.advance(client, message_body, name, chat_id_str)
+                    updates = outcome.updates
+                    if outcome.notification:
+                        for manager_chat_id in MANAGER_CHAT_IDS:
+                            outgoing.append((outcome.notification, manager_chat_id, None))
+                    if outcome.reply:
+                        outgoing.append((outcome.reply, chat_id_str, outcome.keyboard))
+                        messages.append((outcome.reply, True))
+
+                if save_turn(cur, "tg_clients", "tg_messages", client, updates, messages, message_writer):
+                    break
+                client_cache.invalidate(chat_id_str)
             else:
-                reply_text = "Пожалуйста, введите бюджет только цифрами."
-        
-        elif dialog_step == 'get_car_type':
-            cur.execute("SELECT budget FROM tg_clients WHERE id = %s;", (client_id,))
-            budget = cur.fetchone()[0]
-            reply_text = f"Спасибо! Ваш запрос записан:\n\n*Тип авто*: {message_body}\n*Бюджет*: до ${budget}\n\nНаш менеджер скоро с вами свяжется."
-            cur.execute("UPDATE tg_clients SET car_type = %s, dialog_step = 'done', status = 'completed' WHERE id = %s;", (message_body, client_id))
-            manager_notification = f"Новый запрос от {name} (`{chat_id_str}`)\nБюджет: до ${budget}\nТип: {message_body}"
-            send_telegram_message(manager_notification, MANAGER_CHAT_ID)
-
-        if reply_text:
-            send_telegram_message(reply_text, chat_id_str, keyboard)
-            cur.execute("INSERT INTO tg_messages (client_id, message_text, sender_is_bot) VALUES (%s, %s, TRUE);", (client_id, reply_text))
-
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def process_voice_message(file_id, chat_id_str, name):
+                print(f"Не удалось сохранить сообщение клиента {chat_id_str}: состояние меняется параллельно")
+                return
+    except Exception:
+        client_cache.invalidate(chat_id_str)
+        raise
+
+    client.update((key, value) for key, value in updates.items() if key in CLIENT_CACHE_FIELDS)
+    client_cache.set(chat_id_str, client)
+    for text, recipient, keyboard in outgoing:
+        send_telegram_message(text, recipient, keyboard)
+
+def process_voice_message(file_id, chat_id_str, name, file_unique_id=None):
     """Обрабатывает входящие голосовые сообщения."""
-    conn = get_db_connection()
-    cur = conn.cursor()
+    with db_cursor() as cur:
+        client = load_client(cur, chat_id_str, name)
 
-    cur.execute("SELECT id, managed_by_manager FROM tg_clients WHERE chat_id = %s;", (chat_id_str,))
-    client = cur.fetchone()
-    if not client:
-        cur.execute("INSERT INTO tg_clients (chat_id, name) VALUES (%s, %s) RETURNING id, managed_by_manager;", (chat_id_str, name))
-        client = cur.fetchone()
-    client_id, _ = client
-    
-    cur.execute("INSERT INTO tg_messages (client_id, message_text, sender_is_bot, is_voice) VALUES (%s, %s, FALSE, TRUE);", (client_id, "Голосовое сообщение"))
-    
-    voice_content = get_file_content(file_id)
-    if not voice_content: return
-
-    if chat_id_str == MANAGER_CHAT_ID:
-        cur.execute("SELECT chat_id FROM tg_clients WHERE managed_by_manager = TRUE;")
-        active_client = cur.fetchone()
-        if active_client:
-            send_voice_message(voice_content, active_client[0])
-    else:
-        caption = f"Голосовое от {name} (`{chat_id_str}`)"
-        send_voice_message(voice_content, MANAGER_CHAT_ID, caption)
+        if message_writer.buffered:
+            on_commit(message_writer.write_committed, [message_writer.row(
+                client_id=client["id"], message_text="Голосовое сообщение", sender_is_bot=False, is_voice=True)])
+        else:
+            cur.execute("INSERT INTO tg_messages (client_id, message_text, sender_is_bot, is_voice) VALUES (%s, %s, FALSE, TRUE);", (client["id"], "Голосовое сообщение"))
+
+        recipients, caption = [], ""
+        if chat_id_str in MANAGER_CHAT_IDS:
+            _, active_chat_id = load_manager_session(cur, chat_id_str)
+            if active_chat_id:
+                recipients = [active_chat_id]
+        else:
+            manager_chat_id = assigned_manager(cur, client["id"]) if client["managed_by_manager"] else None
+            recipients = [manager_chat_id] if manager_chat_id else list(MANAGER_CHAT_IDS)
+            caption = f"Голосовое от {name} (`{chat_id_str}`)"
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    for recipient in recipients:
+        voice_relay.relay(file_id, file_unique_id, recipient, caption)
 
 # --- WEBHOOK ENDPOINT ---
+def update_chat_key(data):
+    """Ключ очереди апдейта: чат, чтобы сообщения одного клиента шли по порядку."""
+    return data.get('message', {}).get('chat', {}).get('id', data.get('update_id'))
+
+@timed(UPDATE_SECONDS, bot="telegram")
+def handle_update(data):
+    """Разбирает один апдейт Telegram и вызывает нужный обработчик."""
+    # 1. ОБРАБОТКА КОМАНД ОТ MINI APP
+    if 'message' in data and 'web_app_data' in data['message']:
+        chat_id_str = str(data['message']['chat']['id'])
+        if chat_id_str in MANAGER_CHAT_IDS:
+            web_app_data = data['message']['web_app_data']['data']
+            app_data = json.loads(web_app_data)
+
+            if app_data.get('action') == 'get_history':
+                client_chat_id = app_data.get('chat_id')
+                send_client_history(client_chat_id, chat_id_str)
+
+    # 2. ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ
+    elif 'message' in data and 'text' in data['message']:
+        chat_id = data['message']['chat']['id']
+        chat_id_str = str(chat_id)
+        message_text = data['message']['text']
+        user_name = data['message']['from'].get('first_name', 'User')
+
+        if chat_id_str in MANAGER_CHAT_IDS:
+            process_manager_message(message_text, chat_id_str)
+        else:
+            process_client_message(message_text, chat_id_str, user_name)
+
+    # 3. ОБРАБОТКА ГОЛОСОВЫХ СООБЩЕНИЙ
+    elif 'message' in data and 'voice' in data['message']:
+        chat_id = data['message']['chat']['id']
+        chat_id_str = str(chat_id)
+        user_name = data['message']['from'].get('first_name', 'User')
+        file_id = data['message']['voice']['file_id']
+        file_unique_id = data['message']['voice'].get('file_unique_id')
+        process_voice_message(file_id, chat_id_str, user_name, file_unique_id)
+
 @app.route('/webhook', methods=['POST'])
+@timed(WEBHOOK_SECONDS, bot="telegram")
 def telegram_webhook():
     try:
         data = request.get_json()
         if not data: return jsonify(status="ok"), 200
-
-        # 1. ОБРАБОТКА КОМАНД ОТ MINI APP
-        if 'message' in data and 'web_app_data' in data['message']:
-            chat_id_str = str(data['message']['chat']['id'])
-            if chat_id_str == MANAGER_CHAT_ID:
-                web_app_data = data['message']['web_app_data']['data']
-                app_data = json.loads(web_app_data)
-                
-                if app_data.get('action') == 'get_history':
-                    client_chat_id = app_data.get('chat_id')
-                    send_client_history(client_chat_id, MANAGER_CHAT_ID)
-        
-        # 2. ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ
-        elif 'message' in data and 'text' in data['message']:
-            chat_id = data['message']['chat']['id']
-            chat_id_str = str(chat_id)
-            message_text = data['message']['text']
-            user_name = data['message']['from'].get('first_name', 'User')
-
-            if chat_id_str == MANAGER_CHAT_ID:
-                process_manager_message(message_text, chat_id_str)
-            else:
-                process_client_message(message_text, chat_id_str, user_name)
-
-        # 3. ОБРАБОТКА ГОЛОСОВЫХ СООБЩЕНИЙ
-        elif 'message' in data and 'voice' in data['message']:
-            chat_id = data['message']['chat']['id']
-            chat_id_str = str(chat_id)
-            user_name = data['message']['from'].get('first_name', 'User')
-            file_id = data['message']['voice']['file_id']
-            process_voice_message(file_id, chat_id_str, user_name)
-
+        update_id = data.get('update_id') if isinstance(data, dict) else None
+
+        if INGEST_MODE == 'queue':
+            # Только проверяем и ставим в очередь: ответ Telegram уходит сразу,
+            # апдейты одного чата обрабатываются фоновым потоком по порядку.
+            if update_id is None:
+                return jsonify(status="error", reason="malformed update"), 400
+            if update_dedup.is_duplicate(update_id):
+                return jsonify(status="ok", duplicate=True), 200
+            if not update_workers.submit(update_chat_key(data), handle_update, data):
+                # Очередь переполнена: пусть Telegram повторит доставку позже
+                update_dedup.forget(update_id)
+                return jsonify(status="busy"), 503
+            return jsonify(status="ok"), 200
+
+        if update_id is not None and update_dedup.is_duplicate(update_id):
+            return jsonify(status="ok", duplicate=True), 200
+        try:
+            handle_update(data)
+        except Exception:
+            # Ответим 500, и Telegram пришлет апдейт снова — его нельзя отбросить как повтор
+            if update_id is not None:
+                update_dedup.forget(update_id)
+            raise
         return jsonify(status="ok"), 200
     except Exception as e:
         print(f"Критическая ошибка в вебхуке: {e}")
+        WEBHOOK_ERRORS.inc(bot="telegram")
         return jsonify(status="error"), 500
 
-# --- ЗАПУСК ПРИЛОЖЕНИЯ ---
-if __name__ != '__main__':
-    # Эта часть выполняется при старте на Render через Gunicorn
-    init_db()
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики процесса в текстовом формате Prometheus."""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return Response("forbidden\n", status=403, mimetype='text/plain')
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
+# --- ЗАПУСК ПРИЛОЖЕНИЯ ---
+# Под gunicorn схему проверяет мастер до запуска воркеров (gunicorn.conf.py),
+# без него — первый запрос каждого процесса (start_background_jobs).
 if __name__ == "__main__":
     # Эта часть выполняется только при локальном запуске (python telegram_bot.py)
     init_db()
@@ -0,0 +1,111 @@
+"""Запуск Telegram-бота через long polling (getUpdates) вместо вебхука.
+
+    python telegram_polling.py
+
+Подходит для разбора накопившейся очереди апдейтов, нагрузочных тестов против
+локальной заглушки API (TELEGRAM_API_BASE) и окружений без публичного HTTPS.
+Апдейты обрабатываются теми же функциями и тем же пулом, что и в вебхуке.
+"""
+import os
+import time
+import signal
+
+import psycopg2
+import requests
+
+import telegram_bot as bot
+from db import PoolTimeout
+from migrations import ensure_schema
+
+POLL_LIMIT = min(100, int(os.environ.get("POLL_LIMIT", "100")))
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", "30"))
+
+# Сбои сети, API и БД (отсев повторов) временные: опрос ждет и повторяет, а не завершается
+POLL_ERRORS = (requests.exceptions.RequestException, ValueError, RuntimeError, psycopg2.Error, PoolTimeout)
+
+
+class UpdatePoller:
+    """Забирает апдейты пачками и раздает их в пул обработки по ключу чата.
+
+    offset продвигается после того, как пачка принята в очереди пула: следующий
+    getUpdates подтверждает ее Telegram. При заполненных очередях опрос ждет
+    (обратное давление), а не теряет апдейты.
+    """
+
+    def __init__(self, api_url, limit=POLL_LIMIT, timeout=POLL_TIMEOUT):
+        self.api_url = api_url
+        self.limit = limit
+        self.timeout = timeout
+        self.offset = None
+        self.running = True
+        self.session = requests.Session()
+        self._stats = {"polls": 0, "updates": 0, "duplicates": 0, "errors": 0}
+
+    def call(self, method, **params):
+        # Запас к таймауту long polling, чтобы HTTP не обрывался раньше Telegram
+        response = self.session.post(f"{self.api_url}/{method}", json=params, timeout=self.timeout + 10)
+        payload = response.json()
+        if not payload.get("ok"):
+            raise RuntimeError(f"{method}: {payload.get('error_code')} {payload.get('description')}")
+        return payload["result"]
+
+    def poll_once(self):
+        params = {"limit": self.limit, "timeout": self.timeout}
+        if self.offset is not None:
+            params["offset"] = self.offset
+        updates = self.call("getUpdates", **params)
+        self._stats["polls"] += 1
+        if not updates:
+            return 0
+
+        new_ids = bot.update_dedup.filter_new(update["update_id"] for update in updates)
+        for update in updates:
+            if str(update["update_id"]) not in new_ids:
+                self._stats["duplicates"] += 1
+                continue
+            bot.update_workers.submit(bot.update_chat_key(update), bot.handle_update, update, block=True)
+        self.offset = max(update["update_id"] for update in updates) + 1
+        self._stats["updates"] += len(updates)
+        return len(updates)
+
+    def run(self):
+        webhook_deleted = False
+        delay = 1
+        while self.running:
+            try:
+                # Без Flask before_request схему, не проверенную при старте, проверяет опрос
+                ensure_schema("telegram", bot.TELEGRAM_MIGRATIONS)
+                if not webhook_deleted:
+                    # При активном вебхуке getUpdates отвечает 409 Conflict
+                    self.call("deleteWebhook", drop_pending_updates=False)
+                    webhook_deleted = True
+                self.poll_once()
+                delay = 1
+            except POLL_ERRORS as e:
+                self._stats["errors"] += 1
+                print(f"Ошибка опроса Telegram: {e}; повтор через {delay} с")
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def stop(self, *_):
+        self.running = False
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["offset"] = self.offset
+        stats["workers"] = bot.update_workers.stats()
+        return stats
+
+
+if __name__ == "__main__":
+    bot.init_db()
+    bot.message_archive.ensure_started()
+    bot.campaign_runner.ensure_started()
+    poller = UpdatePoller(bot.TELEGRAM_API_URL)
+    signal.signal(signal.SIGTERM, poller.stop)
+    signal.signal(signal.SIGINT, poller.stop)
+    print(f"Long polling запущен: limit={poller.limit}, timeout={poller.timeout} с")
+    poller.run()
+    # Уже принятые апдейты дорабатываются перед выходом
+    bot.update_workers.shutdown()
+    print(f"Long polling остановлен: {poller.stats()}")
@@ -0,0 +1,184 @@
+import os
+import re
+import uuid
+import threading
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StreamingBody:
+    """Итерируемое тело запроса известной длины.
+
+    requests отправляет такие тела с Content-Length и по кускам, не собирая
+    весь файл в памяти; для длины None используется chunked-передача.
+    """
+
+    def __init__(self, chunks, length=None):
+        self._chunks = chunks
+        self._length = length
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def __len__(self):
+        return self._length or 0
+
+
+def multipart_body(boundary, fields, file_field, filename, content_type, chunks, size=None):
+    """Собирает тело multipart/form-data поверх потока кусков файла."""
+    head = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in fields.items()
+    )
+    head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+             f'filename="{filename}"\r\nContent-Type: {content_type}\r\n\r\n').encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def generate():
+        yield head
+        yield from chunks
+        yield tail
+
+    length = len(head) + size + len(tail) if size is not None else None
+    return StreamingBody(generate(), length)
+
+
+class VoiceCache:
+    """Дисковый кэш голосовых по file_unique_id с ограничением общего размера (LRU по mtime)."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, file_unique_id):
+        return os.path.join(self.directory, re.sub(r"[^A-Za-z0-9_-]", "_", file_unique_id) + ".ogg")
+
+    def get(self, file_unique_id):
+        """Путь к сохраненному файлу или None. Обращение продлевает жизнь записи."""
+        path = self.path(file_unique_id)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, file_unique_id, chunks):
+        """Записывает поток во временный файл и атомарно переименовывает его."""
+        path = self.path(file_unique_id)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._evict()
+        return path
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".ogg"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class VoiceRelay:
+    """Пересылка голосовых без буферизации файла целиком в памяти.
+
+    mode="file_id" — повторная отправка по file_id: Telegram сам берет файл у себя,
+    трафика через сервер нет вовсе. mode="stream" — скачивание и загрузка идут
+    одним потоком кусками по CHUNK_SIZE. Если задан cache, копия сохраняется на
+    диск по file_unique_id, и одно и то же голосовое больше не скачивается.
+    Скачивание и загрузка идут в пуле долгих операций outbound, а не в потоке
+    очереди получателей.
+    """
+
+    def __init__(self, outbound, api_url, file_url, mode="file_id", cache=None):
+        self.outbound = outbound
+        self.api_url = api_url
+        self.file_url = file_url
+        self.mode = mode
+        self.cache = cache
+
+    def relay(self, file_id, file_unique_id, chat_id, caption=""):
+        """Ставит пересылку голосового в очередь получателя; обработчик не ждет сети."""
+        if self.mode == "file_id":
+            self.outbound.post_async(chat_id, f"{self.api_url}/sendVoice",
+                                     json={"chat_id": chat_id, "voice": file_id, "caption": caption})
+            if self.cache is not None and file_unique_id:
+                # Копия нужна для архива, но на отправку она не влияет
+                self.outbound.run_background(self.ensure_cached, file_id, file_unique_id)
+        else:
+            self._upload(file_id, file_unique_id, chat_id, caption)
+
+    def ensure_cached(self, file_id, file_unique_id):
+        """Возвращает путь к копии в кэше, скачивая файл потоком только при промахе."""
+        path = self.cache.get(file_unique_id)
+        if path is None:
+            response = self._download(file_id)
+            try:
+                path = self.cache.store(file_unique_id, response.iter_content(CHUNK_SIZE))
+            finally:
+                response.close()
+        return path
+
+    def _upload(self, file_id, file_unique_id, chat_id, caption):
+        fields = {"chat_id": chat_id, "caption": caption}
+        boundary = uuid.uuid4().hex
+
+        if self.cache is not None and file_unique_id:
+            def body_factory():
+                path = self.ensure_cached(file_id, file_unique_id)
+                size = os.path.getsize(path)
+                return multipart_body(boundary, fields, "voice", "voice_message.ogg", "audio/ogg",
+                                      _read_file(path), size)
+        else:
+            def body_factory():
+                # Каждая попытка отправки заново открывает поток скачивания
+                response = self._download(file_id)
+                size = response.headers.get("Content-Length")
+                return multipart_body(boundary, fields, "voice", "voice_message.ogg", "audio/ogg",
+                                      _iter_and_close(response), int(size) if size else None)
+
+        self.outbound.post_async(chat_id, f"{self.api_url}/sendVoice", body_factory=body_factory,
+                                 headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+
+    def _download(self, file_id):
+        session = self.outbound.session
+        response = session.get(f"{self.api_url}/getFile", params={"file_id": file_id}, timeout=10)
+        response.raise_for_status()
+        file_path = response.json()["result"]["file_path"]
+        response = session.get(f"{self.file_url}/{file_path}", stream=True, timeout=10)
+        response.raise_for_status()
+        return response
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _iter_and_close(response):
+    try:
+        yield from response.iter_content(CHUNK_SIZE)
+    finally:
+        response.close()
@@ -0,0 +1,253 @@
+import os
+import time
+import atexit
+import threading
+from collections import deque
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from db import DATABASE_URL, CountingCursor, BROKEN_CONNECTION_ERRORS, mark_background_thread
+from metrics import REGISTRY
+
+# sync — строки пишутся в транзакции вызывающего, как без буфера;
+# group — строки копятся и коммитятся пачкой, write() ждет коммита своей пачки;
+# async — write() сразу возвращается, пачка коммитится с synchronous_commit=off
+# (при падении процесса или БД теряются строки последних долей секунды).
+# execute() в обоих буферизованных режимах ждет коммита: ему нужен результат.
+DURABILITY_MODES = ("sync", "group", "async")
+
+FLUSH_SECONDS = REGISTRY.histogram(
+    "message_flush_duration_seconds", "Время записи одной пачки сообщений", ["table"])
+FLUSH_ROWS = REGISTRY.histogram(
+    "message_flush_rows", "Строк в одной пачке сообщений", ["table"],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+WRITE_LATENCY = REGISTRY.histogram(
+    "message_write_latency_seconds", "Время от постановки строки в буфер до коммита", ["table"])
+
+
+class _Ticket:
+    """Строки одного вызова write() или запрос execute(); вызывающий может ждать коммита."""
+
+    def __init__(self, rows=None, statement=None, size=None):
+        self.rows = rows or []
+        self.statement = statement
+        self.size = size if size is not None else len(self.rows)
+        self.result = None
+        self.queued_at = time.perf_counter()
+        self.error = None
+        self.done = threading.Event()
+
+
+class BufferedWriter:
+    """Групповая запись строк в таблицу многострочным INSERT.
+
+    Строки из параллельных обработчиков копятся в буфере процесса, и фоновый
+    поток записывает их одной транзакцией, как только набралось max_rows строк
+    или первая строка ждет дольше max_delay секунд. Пишет отдельное соединение
+    (не из пула): ожидающие коммита обработчики не могут занять все соединения
+    пула и заблокировать саму запись. Порядок строк сохраняется.
+    """
+
+    def __init__(self, table, columns, durability="group", max_rows=500, max_delay=0.02, timeout=10, defaults=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Неизвестный режим записи {durability}, допустимые: {', '.join(DURABILITY_MODES)}")
+        self.table = table
+        self.columns = tuple(columns)
+        self.defaults = dict(defaults or {})
+        self.durability = durability
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self._query = f"INSERT INTO {table} ({', '.join(self.columns)}) VALUES %s"
+        self._pending = deque()
+        self._pending_rows = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._stats = {"flushes": 0, "rows": 0, "failed_rows": 0, "reconnects": 0}
+
+    @property
+    def buffered(self):
+        """False в режиме sync: вызывающий пишет строки сам в своей транзакции."""
+        return self.durability != "sync"
+
+    def row(self, **values):
+        """Строка в порядке columns; не переданные столбцы берутся из defaults."""
+        return tuple(values[column] if column in values else self.defaults.get(column) for column in self.columns)
+
+    def write(self, rows):
+        """Ставит строки в буфер. В режиме group ждет коммита и пробрасывает ошибку записи."""
+        if not rows:
+            return
+        ticket = self._enqueue(_Ticket(rows))
+        if self.durability == "group":
+            self._wait(ticket)
+
+    def write_committed(self, rows):
+        """write() для строк, чья транзакция уже закоммичена (см. db.on_commit).
+
+        Ошибка записи не пробрасывается: сохраненное изменение (шаг диалога,
+        статусы рассылки) повторная доставка применила бы второй раз. Строки,
+        которые не удалось записать, видны в логе и в message_writer_failed_rows.
+        """
+        try:
+            self.write(rows)
+        except Exception as e:
+            print(f"{len(rows)} строк не записаны в {self.table}: {e}")
+
+    def execute(self, query, params, size=1):
+        """Выполняет запрос в транзакции очередной пачки и возвращает его rowcount.
+
+        Так в общий коммит попадает запись с условием (шаг диалога вместе с
+        сообщениями хода): запросы и строки пачки выполняются по порядку
+        постановки. size — сколько строк пишет запрос, для порога max_rows.
+        """
+        ticket = self._wait(self._enqueue(_Ticket(statement=(query, params), size=size)))
+        return ticket.result
+
+    def _enqueue(self, ticket):
+        self._ensure_started()
+        with self._cond:
+            self._pending.append(ticket)
+            self._pending_rows += ticket.size
+            self._cond.notify()
+        return ticket
+
+    def _wait(self, ticket):
+        """Ждет коммита записи. TimeoutError означает, что запись не выполнена и не будет.
+
+        Запись, которую поток еще не взял в пачку, по таймауту снимается с
+        очереди, и вызывающий может безопасно повторить ее (например, через
+        повторную доставку апдейта). Если пачка с ней уже пишется, исход
+        неизвестен до коммита или отката, поэтому ожидание продолжается.
+        """
+        if not ticket.done.wait(self.timeout):
+            with self._cond:
+                queued = ticket in self._pending
+                if queued:
+                    self._pending.remove(ticket)
+                    self._pending_rows -= ticket.size
+            if queued:
+                raise TimeoutError(f"Запись в {self.table} не началась за {self.timeout} с и отменена")
+            ticket.done.wait()
+        if ticket.error is not None:
+            raise ticket.error
+        return ticket
+
+    # --- ФОНОВАЯ ЗАПИСЬ ---
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            # Буфер и соединение, унаследованные через fork, принадлежат родителю
+            self._pending, self._pending_rows, self._conn = deque(), 0, None
+            threading.Thread(target=self._run, name=f"writer-{self.table}", daemon=True).start()
+            self._pid = os.getpid()
+        atexit.register(self.flush)
+
+    def _run(self):
+        mark_background_thread()
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # Ждем, пока пачка наберется или первая строка не прождет max_delay
+                deadline = self._pending[0].queued_at + self.max_delay
+                while self._pending_rows < self.max_rows:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            self.flush()
+
+    def flush(self):
+        """Записывает все, что накопилось в буфере (по max_rows строк за транзакцию)."""
+        with self._flush_lock:
+            while self._flush_batch():
+                pass
+
+    def _flush_batch(self):
+        with self._cond:
+            batch, rows = [], 0
+            while self._pending and (not batch or rows + self._pending[0].size <= self.max_rows):
+                ticket = self._pending.popleft()
+                batch.append(ticket)
+                rows += ticket.size
+            self._pending_rows -= rows
+        if not batch:
+            return False
+        self._write_batch(batch)
+        return True
+
+    def _write_batch(self, batch):
+        started = time.perf_counter()
+        failed = []
+        try:
+            self._run_tickets(batch)
+        except Exception as e:
+            print(f"Ошибка групповой записи в {self.table}: {e}; запись по одному вызову")
+            # Одна плохая строка не должна терять строки остальных обработчиков
+            for ticket in batch:
+                try:
+                    self._run_tickets([ticket])
+                except Exception as error:
+                    ticket.error = error
+                    failed.append(ticket)
+                    print(f"Не удалось записать {ticket.size} строк в {self.table}: {error}")
+        finished = time.perf_counter()
+        rows = sum(ticket.size for ticket in batch)
+        failed_rows = sum(ticket.size for ticket in failed)
+        FLUSH_SECONDS.observe(finished - started, table=self.table)
+        FLUSH_ROWS.observe(rows, table=self.table)
+        with self._cond:
+            self._stats["flushes"] += 1
+            self._stats["rows"] += rows - failed_rows
+            self._stats["failed_rows"] += failed_rows
+        for ticket in batch:
+            WRITE_LATENCY.observe(finished - ticket.queued_at, table=self.table)
+            ticket.done.set()
+
+    def _run_tickets(self, tickets):
+        """Одна транзакция: подряд идущие строки — одним INSERT, запросы — по очереди между ними."""
+        conn = self._connection()
+        try:
+            with conn.cursor() as cur:
+                if self.durability == "async":
+                    cur.execute("SET LOCAL synchronous_commit TO off;")
+                rows = []
+                for ticket in tickets:
+                    if ticket.statement is None:
+                        rows.extend(ticket.rows)
+                        continue
+                    if rows:
+                        execute_values(cur, self._query, rows, page_size=len(rows))
+                        rows = []
+                    cur.execute(*ticket.statement)
+                    ticket.result = cur.rowcount
+                if rows:
+                    execute_values(cur, self._query, rows, page_size=len(rows))
+            conn.commit()
+        except BROKEN_CONNECTION_ERRORS:
+            self._conn = None
+            conn.close()
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            if self._stats["flushes"]:
+                self._stats["reconnects"] += 1
+            self._conn = psycopg2.connect(DATABASE_URL, cursor_factory=CountingCursor)
+        return self._conn
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["pending_rows"] = self._pending_rows
+        return stats